@@ -0,0 +1,43 @@
+import logging, os, queue, threading
+
+# Writes files on a background thread so that the disk writes, and any
+# fsync, never block the reactor. Writes are made in the order given.
+class BackgroundWriter:
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def append(self, lines):
+        self.put(self._append, lines)
+
+    def replace(self, data):
+        # Replace the file atomically, so it holds either the old or the new
+        # data after a crash
+        self.put(self._replace, data)
+
+    def put(self, write, data):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.queue.put((write, data))
+
+    def _run(self):
+        while True:
+            write, data = self.queue.get()
+            try:
+                write(data)
+            except Exception:
+                logging.exception(f'Unable to write {self.path}')
+
+    def _append(self, lines):
+        with open(self.path, 'a') as f:
+            f.writelines(line + '\n' for line in lines)
+
+    def _replace(self, data):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
@@ -4,6 +4,8 @@ class Berth:
         self.name = config.get_name().split(' ')[-1]
         self.dock = config.get('dock')
         self.x_pos = float(config.get('x_pos'))
+        # A staging berth can hold any carriage parked near the next tool
+        self.staging = config.getboolean('staging', False)
         self.printer.add_object('berth ' + self.name, self)
 
 
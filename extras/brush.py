@@ -1,3 +1,5 @@
+BRUSH_PATTERNS = ('diagonal', 'zigzag', 'wipe')
+
 class Brush:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -9,8 +11,83 @@ class Brush:
         self.brush_y_pos = float(config.get('brush_y_pos') or 100)
         self.brush_speed = float(config.get('brush_speed') or 100)
         self.safe_z_pos_for_brush = float(config.get('safe_z_pos_for_brush') or 30)
-        self.purge_length = float(config.get('purge_length') or 10)
+        self.brush_pattern = config.getchoice(
+            'brush_pattern', {p: p for p in BRUSH_PATTERNS}, 'diagonal')
+        self.brush_passes = config.getint('brush_passes', 4, minval=1)
+        # Corner velocity used while brushing, None leaves it unchanged
+        self.brush_square_corner_velocity = config.getfloat(
+            'brush_square_corner_velocity', None, minval=0.)
         self.printer.add_object('brush', self)
+        self.printer.register_event_handler('klippy:connect', self.handle_connect)
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command('BRUSH', self.cmd_BRUSH,
+                                    desc=self.cmd_BRUSH_help)
+
+    def handle_connect(self):
+        self.toolhead = self.printer.lookup_object('toolhead')
+        self.gcode_move = self.printer.lookup_object('gcode_move')
+
+    def pass_moves(self, pattern):
+        # Relative (dx, dy) moves of one pass, each pass ends brush_shift * 2
+        # further along X, or back where it started for a wipe
+        movement, shift = self.brush_movement, self.brush_shift
+        if pattern == 'diagonal':
+            reverse = -2 * movement + shift
+            return [(movement, movement), (movement, movement), (reverse, 0.),
+                    (movement, -movement), (movement, -movement), (reverse, 0.)]
+        if pattern == 'zigzag':
+            return [(movement, movement), (-movement, movement), (shift, 0.),
+                    (movement, -movement), (-movement, -movement), (shift, 0.)]
+        return [(-self.brush_offset, 0.), (self.brush_offset, 0.)]
+
+    def pattern_moves(self, pattern, passes):
+        # Relative (dx, dy) moves from the brush position, down onto the
+        # brush, across it and back to the brush position
+        moves = [(0., -self.brush_movement)]
+        if pattern == 'diagonal':
+            moves.append((-self.brush_offset, 0.))
+        elif pattern == 'zigzag':
+            moves.append((-self.brush_length, 0.))
+        moves.extend(self.pass_moves(pattern) * passes)
+        return moves
+
+    def brush(self, pattern, passes):
+        # Queue the whole pattern at once through the move transforms so that
+        # lookahead blends it into one continuous run
+        square_corner_velocity = self.toolhead.square_corner_velocity
+        if self.brush_square_corner_velocity is not None:
+            self.set_square_corner_velocity(self.brush_square_corner_velocity)
+        pos = self.gcode_move.position_with_transform()
+        max_velocity = self.toolhead.get_max_velocity()[0]
+        # Clear the brush holder and the part before travelling over them
+        if pos[2] < self.safe_z_pos_for_brush:
+            pos[2] = self.safe_z_pos_for_brush
+            self.gcode_move.move_with_transform(list(pos), max_velocity)
+        pos[0], pos[1] = self.brush_x_pos, self.brush_y_pos
+        self.gcode_move.move_with_transform(list(pos), max_velocity)
+        for dx, dy in self.pattern_moves(pattern, passes):
+            pos[0] += dx
+            pos[1] += dy
+            self.gcode_move.move_with_transform(list(pos), self.brush_speed)
+        pos[0], pos[1] = self.brush_x_pos, self.brush_y_pos
+        self.gcode_move.move_with_transform(list(pos), max_velocity)
+        self.gcode_move.reset_last_position()
+        if self.brush_square_corner_velocity is not None:
+            self.set_square_corner_velocity(square_corner_velocity)
+
+    def set_square_corner_velocity(self, square_corner_velocity):
+        self.gcode.run_script_from_command(
+            'SET_VELOCITY_LIMIT SQUARE_CORNER_VELOCITY=%.3f'
+            % (square_corner_velocity,))
+
+    cmd_BRUSH_help = 'Brush the nozzle of the current tool'
+    def cmd_BRUSH(self, gcmd):
+        pattern = gcmd.get('PATTERN', self.brush_pattern).lower()
+        if pattern not in BRUSH_PATTERNS:
+            raise gcmd.error(f'Unknown brush pattern {pattern}')
+        passes = gcmd.get_int('PASSES', self.brush_passes, minval=1)
+        gcmd.respond_info('Brushing')
+        self.brush(pattern, passes)
 
 
 def load_config(config):
@@ -8,6 +8,18 @@ class Carriage:
         self.offset_x = float(config.get('offset_x') or 0)
         self.offset_y = float(config.get('offset_y') or 0)
         self.offset_z = float(config.get('offset_z') or 0)
+        # The configured offsets, before any calibration changes them
+        self.config_offset = (self.offset_x, self.offset_y, self.offset_z)
+        # Motion limits while this carriage is loaded. Unset values fall back
+        # to the [printer] and [input_shaper] settings.
+        self.max_velocity = config.getfloat('max_velocity', None, above=0.)
+        self.max_accel = config.getfloat('max_accel', None, above=0.)
+        self.square_corner_velocity = config.getfloat(
+            'square_corner_velocity', None, minval=0.)
+        self.shaper_freq_x = config.getfloat('shaper_freq_x', None, minval=0.)
+        self.shaper_freq_y = config.getfloat('shaper_freq_y', None, minval=0.)
+        self.shaper_type_x = config.get('shaper_type_x', None)
+        self.shaper_type_y = config.get('shaper_type_y', None)
         # self.loaded_button = config.get('loaded_button')
         self.calibrated = False
         self.printer.add_object('carriage ' + self.name, self)
@@ -16,6 +28,14 @@ class Carriage:
         self.after_load_gcode = config.get('after_load_gcode', 'RESPOND MSG=Loaded')
         self.after_unload_gcode = config.get('after_unload_gcode', 'RESPOND MSG=Unloaded')
 
+    def get_status(self, eventtime):
+        return {'berth': self.berth,
+                'tool_number': self.tool_number,
+                'offset_x': self.offset_x,
+                'offset_y': self.offset_y,
+                'offset_z': self.offset_z,
+                'calibrated': self.calibrated}
+
     def validate_name(name):
         if name == 'none':
             raise Exception("Carriage name cannot be 'none'")
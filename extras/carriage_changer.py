@@ -1,4 +1,621 @@
-import os
+import collections, itertools, json, logging, math, os, re, time, types
+from . import background_writer
+
+# Resolved objects and absolute dock coordinates for one carriage
+CarriageTopology = collections.namedtuple('CarriageTopology', (
+    'carriage', 'berth', 'dock', 'align_x', 'engage_x', 'safe_y', 'dock_y'))
+
+# One action of a planned tool change, run by CarriageChanger.step_<action>.
+# Steps with a phase have their duration recorded by ToolChangeTelemetry.
+ToolChangeStep = collections.namedtuple('ToolChangeStep',
+                                        ('action', 'args', 'phase'),
+                                        defaults=(None,))
+
+MOTION_PROFILE_OPTIONS = (
+    ('max_velocity', 'printer', 'max_velocity'),
+    ('max_accel', 'printer', 'max_accel'),
+    ('square_corner_velocity', 'printer', 'square_corner_velocity'),
+    ('shaper_freq_x', 'input_shaper', 'shaper_freq_x'),
+    ('shaper_type_x', 'input_shaper', 'shaper_type_x'),
+    ('shaper_freq_y', 'input_shaper', 'shaper_freq_y'),
+    ('shaper_type_y', 'input_shaper', 'shaper_type_y'))
+
+TOOL_CHANGE_PHASES = ('safe_z', 'align', 'engage', 'extract', 'offset',
+                      'before_hooks', 'after_hooks')
+
+TOOL_CHANGE_RE = re.compile(
+    r'^\s*(?:T(?P<tool>\d+)\b|(?:LOAD_CARRIAGE|LOAD_EXTRUDER)\s.*'
+    r'\bCARRIAGE=[\'"]?(?P<carriage>\w+))', re.IGNORECASE)
+HEATER_RE = re.compile(r'^\s*M10[49]\s', re.IGNORECASE)
+LAYER_RE = re.compile(r'^;\s*(?:LAYER_CHANGE|LAYER:)')
+XY_MOVE_RE = re.compile(r'^\s*G[01]\s[^;]*[XY]-?[\d.]', re.IGNORECASE)
+
+def move_time(distance, speed, accel):
+    # Time for a move that starts and ends at rest with a trapezoid profile
+    if distance <= 0.:
+        return 0.
+    if distance < speed * speed / accel:
+        return 2. * math.sqrt(distance / accel)
+    return distance / speed + speed / accel
+
+# Scans the print file ahead of the virtual_sdcard position for the next
+# tool change, so that the carriage can be prepared before it is needed.
+class ToolChangeLookahead:
+    def __init__(self, config, carriage_changer):
+        self.printer = config.get_printer()
+        self.carriage_changer = carriage_changer
+        self.lookahead_bytes = config.getint('lookahead_bytes', 0, minval=0)
+        self.lookahead_interval = config.getfloat('lookahead_interval', 5.,
+                                                  above=0.)
+        self.next_carriage = None
+        self.next_temperature = None
+        self.next_plan = None
+        self.reset_scan(None)
+        if self.lookahead_bytes:
+            self.printer.register_event_handler('klippy:ready',
+                                                self.handle_ready)
+
+    def handle_ready(self):
+        reactor = self.printer.get_reactor()
+        reactor.register_timer(self.scan, reactor.NOW)
+
+    def scan(self, eventtime):
+        try:
+            self.update(self.find_next_tool_change())
+        except Exception:
+            logging.exception('Tool change lookahead failed')
+        return eventtime + self.lookahead_interval
+
+    def reset_scan(self, path):
+        # The file is scanned a line at a time from scan_position, which is
+        # None until the first complete line after the print position
+        self.scan_path = path
+        self.scan_position = None
+        self.scan_found = None
+        self.scan_temperatures = {}
+        self.print_position = 0
+
+    def find_next_tool_change(self):
+        # Only the bytes that came into the lookahead window since the last
+        # scan are read, and none once the next tool change has been found
+        sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        if sdcard is None or not sdcard.is_active():
+            self.reset_scan(None)
+            return None, None
+        path = sdcard.file_path()
+        position = sdcard.file_position
+        if path != self.scan_path or position < self.print_position:
+            self.reset_scan(path)
+        self.print_position = position
+        loaded = self.carriage_changer.loaded_carriage
+        if self.scan_found is not None:
+            offset, topology, temperature = self.scan_found
+            if position < offset and topology.carriage.name != loaded:
+                return topology, temperature
+            self.scan_found = None
+            self.scan_temperatures = {}
+        start = self.scan_position
+        if start is not None and start < position:
+            start = None
+        end = position + self.lookahead_bytes
+        with open(path, 'rb') as f:
+            f.seek(position if start is None else start)
+            data = f.read(max(0, end - f.tell()))
+        if start is None:
+            # Skip the rest of the line at the print position
+            skip = data.find(b'\n') + 1
+            if not skip:
+                return None, None
+            start = position + skip
+            data = data[skip:]
+        data = data[:data.rfind(b'\n') + 1]
+        for line in data.splitlines(True):
+            start += len(line)
+            self.scan_position = start
+            topology, temperature = self.scan_line(
+                line.decode(errors='ignore'), loaded)
+            if topology is not None:
+                self.scan_found = (start, topology, temperature)
+                return topology, temperature
+        self.scan_position = start
+        return None, None
+
+    def scan_line(self, line, loaded):
+        line = line.split(';')[0]
+        if HEATER_RE.match(line):
+            tool = re.search(r'\bT(\d+)', line)
+            temperature = re.search(r'\bS([\d.]+)', line)
+            if tool and temperature:
+                self.scan_temperatures[tool.group(1)] = float(temperature.group(1))
+            return None, None
+        match = TOOL_CHANGE_RE.match(line)
+        if match is None:
+            return None, None
+        topology = self.carriage_changer.lookup_tool_change(
+            match.group('carriage'), match.group('tool'))
+        if topology is None or topology.carriage.name == loaded:
+            return None, None
+        temperature = re.search(r'\bTEMPERATURE=([\d.]+)', line,
+                                re.IGNORECASE)
+        if temperature:
+            return topology, float(temperature.group(1))
+        return topology, self.scan_temperatures.get(topology.carriage.tool_number)
+
+    def update(self, next_tool_change):
+        topology, temperature = next_tool_change
+        carriage_name = topology.carriage.name if topology else None
+        if (carriage_name == self.next_carriage
+                and temperature == self.next_temperature):
+            return
+        self.next_carriage = carriage_name
+        self.next_temperature = temperature
+        self.next_plan = None
+        if topology is None:
+            return
+        # Plan the change now so it is ready when the tool change is reached
+        loaded = self.carriage_changer.loaded_carriage
+        self.next_plan = (loaded, carriage_name,
+                          self.carriage_changer.plan_load(topology))
+        self.preheat(carriage_name, temperature)
+
+    def preheat(self, carriage_name, temperature):
+        # Let the standby manager bring the extruder back up if there is one
+        manager = self.printer.lookup_object('extruder_management', None)
+        if manager is not None:
+            manager.preheat(carriage_name, temperature)
+            return
+        extruder = self.printer.lookup_object(carriage_name, None)
+        if not temperature or not hasattr(extruder, 'get_heater'):
+            return
+        heater = extruder.get_heater()
+        eventtime = self.printer.get_reactor().monotonic()
+        if heater.get_temp(eventtime)[1] < temperature:
+            logging.info(f'Preheating {carriage_name} to {temperature:.1f}'
+                         ' ahead of the tool change')
+            heater.set_temp(temperature)
+
+    def take_plan(self, loaded, carriage_name):
+        # Return the prepared plan if it is for this change
+        if self.next_plan is None or self.next_plan[:2] != (loaded, carriage_name):
+            return None
+        plan = self.next_plan[2]
+        self.next_plan = None
+        return plan
+
+    def get_status(self, eventtime):
+        return {'next_carriage': self.next_carriage or 'none',
+                'next_temperature': self.next_temperature}
+
+# G-Code move transform that offsets moves by the loaded carriage's
+# calibrated offsets, in place of setting and clearing the gcode offset on
+# every tool change. It sits in front of any other transform (eg bed_mesh).
+class CarriageOffsetTransform:
+    def __init__(self, printer):
+        self.printer = printer
+        self.gcode_move = self.next_transform = None
+        self.carriage = None
+        self.offset = [0., 0., 0.]
+
+    def register(self):
+        self.gcode_move = self.printer.lookup_object('gcode_move')
+        self.next_transform = self.gcode_move.set_move_transform(self, force=True)
+
+    def set_carriage(self, carriage):
+        # Offsets are read here as calibration may have changed them
+        self.carriage = carriage
+        if carriage is None:
+            self.offset = [0., 0., 0.]
+        else:
+            self.offset = [carriage.offset_x, carriage.offset_y,
+                           carriage.offset_z]
+        self.gcode_move.reset_last_position()
+
+    def get_position(self):
+        pos = self.next_transform.get_position()
+        return [p - o for p, o in zip(pos, self.offset)] + pos[3:]
+
+    def move(self, newpos, speed):
+        pos = [p + o for p, o in zip(newpos, self.offset)] + newpos[3:]
+        self.next_transform.move(pos, speed)
+
+    def get_status(self, eventtime):
+        return {'carriage_offset': {
+            'carriage': self.carriage.name if self.carriage else 'none',
+            'x': self.offset[0], 'y': self.offset[1], 'z': self.offset[2]}}
+
+# Keeps the print time durations of the most recent tool changes, in total
+# and per phase, for reporting percentiles.
+class ToolChangeTelemetry:
+    def __init__(self, config):
+        samples = config.getint('telemetry_samples', 50, minval=1)
+        self.durations = {phase: collections.deque(maxlen=samples)
+                          for phase in TOOL_CHANGE_PHASES + ('total',)}
+
+    def record(self, durations):
+        for phase, duration in durations.items():
+            self.durations[phase].append(duration)
+
+    def percentiles(self, samples):
+        if not samples:
+            return {'count': 0, 'p50': 0., 'p90': 0., 'max': 0.}
+        ordered = sorted(samples)
+        def rank(p):
+            return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+        return {'count': len(ordered), 'p50': rank(.5), 'p90': rank(.9),
+                'max': ordered[-1]}
+
+    def get_status(self, eventtime):
+        return {'timing': {phase: self.percentiles(samples)
+                           for phase, samples in self.durations.items()}}
+
+# Reorders the tool blocks within each layer of a print file so that the
+# tool changes take the least time according to the changer cost model.
+class ToolOrderOptimizer:
+    # Layers with more tools than this are ordered greedily
+    MAX_EXHAUSTIVE_TOOLS = 5
+    # Lines read between letting the reactor run its timers
+    PAUSE_LINES = 10000
+
+    def __init__(self, config, carriage_changer):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.carriage_changer = carriage_changer
+        self.change_lines = {}
+        self.costs = {}
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command('ESTIMATE_TOOL_CHANGES',
+                               self.cmd_ESTIMATE_TOOL_CHANGES,
+                               desc=self.cmd_ESTIMATE_TOOL_CHANGES_help)
+
+    def change_cost(self, from_name, to_name):
+        key = (from_name, to_name)
+        if key not in self.costs:
+            self.costs[key] = self.carriage_changer.estimate_change_time(
+                from_name, to_name)
+        return self.costs[key]
+
+    def pause(self):
+        # The file is worked through inside a gcode command, so let the
+        # heater and MCU timers run in between
+        self.reactor.pause(self.reactor.monotonic())
+
+    def read_lines(self, path):
+        lines = []
+        with open(path, 'r', errors='ignore') as f:
+            for line in f:
+                lines.append(line)
+                if not len(lines) % self.PAUSE_LINES:
+                    self.pause()
+        return lines
+
+    def split_sections(self, lines):
+        # The start gcode and each layer, the last of which holds the end gcode
+        sections = [[]]
+        for line in lines:
+            if LAYER_RE.match(line) and sections[-1]:
+                sections.append([])
+            sections[-1].append(line)
+        return sections
+
+    def split_blocks(self, lines, tool):
+        # Split a section into header lines, which hold the layer change, and
+        # [tool, change_line, body] blocks that each print with one tool.
+        # Returns None for the blocks if a tool change is not recognised.
+        header = []
+        blocks = [[tool, None, []]]
+        for line in lines:
+            match = TOOL_CHANGE_RE.match(line.split(';')[0])
+            if match is not None:
+                topology = self.carriage_changer.lookup_tool_change(
+                    match.group('carriage'), match.group('tool'))
+                if topology is None:
+                    return header, None
+                tool = topology.carriage.name
+                self.change_lines[tool] = line
+                blocks.append([tool, line, []])
+            elif len(blocks) == 1 and not blocks[0][2] and not XY_MOVE_RE.match(line):
+                header.append(line)
+            else:
+                blocks[-1][2].append(line)
+        return header, [b for b in blocks if b[1] is not None or b[2]]
+
+    def order_tools(self, tools, active):
+        # Carrying on with the same tool needs no change
+        def step_cost(a, b):
+            return 0. if a == b else self.change_cost(a, b)
+        def cost(order):
+            return sum(step_cost(a, b) for a, b in zip((active,) + order, order))
+        if len(tools) > self.MAX_EXHAUSTIVE_TOOLS:
+            order = []
+            remaining = list(tools)
+            while remaining:
+                last = order[-1] if order else active
+                tool = min(remaining, key=(lambda t: step_cost(last, t)))
+                remaining.remove(tool)
+                order.append(tool)
+            return order
+        # The original order comes first so it is kept on a tie
+        return min(itertools.permutations(tools), key=cost)
+
+    def reorder_blocks(self, blocks, active):
+        merged = collections.OrderedDict()
+        for tool, change_line, body in blocks:
+            if tool not in merged:
+                merged[tool] = [tool, change_line, []]
+            merged[tool][2] += body
+        order = self.order_tools(tuple(merged), active)
+        return [merged[tool] for tool in order]
+
+    def optimize(self, lines, reorder):
+        # Returns the (possibly reordered) lines, the number of tool changes
+        # and their predicted total time
+        self.change_lines = {}
+        sections = self.split_sections(lines)
+        output = []
+        tool = active = None
+        changes = 0
+        change_time = 0.
+        for i, section in enumerate(sections):
+            self.pause()
+            header, blocks = self.split_blocks(section, tool)
+            output += header
+            if blocks is None:
+                return lines, None, None
+            if blocks:
+                tool = blocks[-1][0]
+            # The start and end gcode are never reordered
+            if reorder and 0 < i < len(sections) - 1 and None not in (
+                    b[0] for b in blocks):
+                blocks = self.reorder_blocks(blocks, active)
+            for block_tool, change_line, body in blocks:
+                if block_tool != active:
+                    output.append(change_line or self.change_lines[block_tool])
+                    changes += 1
+                    change_time += self.change_cost(active, block_tool)
+                    active = block_tool
+                output += body
+        return output, changes, change_time
+
+    def is_reorderable(self, lines):
+        # Blocks can only be moved when extrusion is relative
+        commands = [l.split(';')[0].strip().upper() for l in lines]
+        return 'M83' in commands and 'M82' not in commands
+
+    def find_attached_command(self, lines):
+        # Only the tool change line moves with its block, so any retract,
+        # wipe, prime or heater command next to it would be left with the
+        # wrong tool. Returns the line number and command of the first one.
+        # Commands before the first XY move of a layer are not moved.
+        previous = previous_number = None
+        in_header = True
+        tool_change = False
+        for number, line in enumerate(lines, 1):
+            if LAYER_RE.match(line):
+                previous, in_header = None, True
+                continue
+            command = line.split(';')[0].strip()
+            if not command:
+                continue
+            is_xy_move = XY_MOVE_RE.match(command) is not None
+            if tool_change and not is_xy_move:
+                return number, command
+            tool_change = TOOL_CHANGE_RE.match(command) is not None
+            if tool_change:
+                if not in_header and not XY_MOVE_RE.match(previous or ''):
+                    return previous_number, previous
+            elif is_xy_move:
+                in_header = False
+            previous, previous_number = command, number
+        return None
+
+    cmd_ESTIMATE_TOOL_CHANGES_help = (
+        'Predict the tool change time of a print file and optionally write a'
+        ' copy with the tools reordered in each layer')
+    def cmd_ESTIMATE_TOOL_CHANGES(self, gcmd):
+        sdcard = self.printer.lookup_object('virtual_sdcard')
+        filename = gcmd.get('FILENAME')
+        reorder = gcmd.get_int('REORDER', 0, minval=0, maxval=1)
+        # Reading and parsing the whole file would stall the print
+        if sdcard.is_active():
+            raise gcmd.error('Cannot estimate tool changes while printing')
+        path = os.path.join(sdcard.sdcard_dirname, filename)
+        try:
+            lines = self.read_lines(path)
+        except IOError:
+            raise gcmd.error(f'Unable to open file {filename}')
+        self.costs = {}
+        unused, changes, change_time = self.optimize(lines, False)
+        if changes is None:
+            raise gcmd.error(f'{filename} has a tool change without a carriage')
+        gcmd.respond_info(f'{filename}: {changes} tool changes, predicted'
+                          f' {change_time:.1f}s')
+        if not reorder:
+            return
+        if not self.is_reorderable(lines):
+            raise gcmd.error(
+                f'{filename} must use relative extrusion (M83) to be reordered')
+        attached = self.find_attached_command(lines)
+        if attached is not None:
+            raise gcmd.error(
+                f'{filename} cannot be reordered as {attached[1]!r} is next to'
+                f' a tool change (around line {attached[0]})')
+        output, changes, change_time = self.optimize(lines, True)
+        out_name = '%s_reordered%s' % os.path.splitext(filename)
+        out_path = os.path.join(sdcard.sdcard_dirname, out_name)
+        with open(out_path + '.tmp', 'w') as f:
+            f.writelines(output)
+        os.replace(out_path + '.tmp', out_path)
+        gcmd.respond_info(f'{out_name}: {changes} tool changes, predicted'
+                          f' {change_time:.1f}s')
+
+# Persists the loaded carriage and the carriage calibrations so they
+# survive a restart. A tool change is recorded as pending before it starts
+# and only cleared once its moves have finished, so a restart part way
+# through a change is detected.
+class CarriageState:
+    STATE_VERSION = 1
+    # Allow the buttons to report their state before reconciling
+    RECONCILE_DELAY = 1.
+
+    def __init__(self, config, carriage_changer):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.carriage_changer = carriage_changer
+        self.path = config.get('state_path', None)
+        self.writer = None
+        if self.path is not None:
+            self.path = os.path.expanduser(self.path)
+            self.writer = background_writer.BackgroundWriter(self.path)
+        self.change_id = 0
+        # The change whose completion complete_timer will record
+        self.completed_id = None
+        self.complete_timer = self.reactor.register_timer(self.handle_complete)
+        self.calibrated_at = {}
+        self.restored_carriage = None
+        if self.path is not None:
+            self.printer.register_event_handler('klippy:ready',
+                                                self.handle_ready)
+
+    def snapshot(self, pending):
+        carriages = {}
+        for name, topology in self.carriage_changer.topology.items():
+            carriage = topology.carriage
+            if carriage.calibrated:
+                self.calibrated_at.setdefault(name, time.time())
+            else:
+                self.calibrated_at.pop(name, None)
+            carriages[name] = {'berth': topology.berth.name,
+                               'offset_x': carriage.offset_x,
+                               'offset_y': carriage.offset_y,
+                               'offset_z': carriage.offset_z,
+                               'config_offset': list(carriage.config_offset),
+                               'calibrated': carriage.calibrated,
+                               'calibrated_at': self.calibrated_at.get(name)}
+        return {'version': self.STATE_VERSION,
+                'loaded_carriage': self.carriage_changer.loaded_carriage,
+                'pending': pending,
+                'carriages': carriages}
+
+    def write(self, pending=None):
+        if self.writer is not None:
+            self.writer.replace(json.dumps(self.snapshot(pending), indent=2))
+
+    def read(self):
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            logging.exception(f'Unable to read carriage state {self.path}')
+            return None
+        if state.get('version') != self.STATE_VERSION:
+            return None
+        return state
+
+    def begin_change(self, target):
+        # Record the change before any of its moves are queued
+        self.change_id += 1
+        self.write({'from': self.carriage_changer.loaded_carriage,
+                    'to': target})
+        return self.change_id
+
+    def complete_change(self, print_time, change_id):
+        # Record the result once the toolhead reaches print_time, unless
+        # another change has begun since
+        if change_id != self.change_id:
+            return
+        self.completed_id = change_id
+        mcu = self.printer.lookup_object('mcu')
+        now = self.reactor.monotonic()
+        delay = max(0., print_time - mcu.estimated_print_time(now))
+        self.reactor.update_timer(self.complete_timer, now + delay)
+
+    def handle_complete(self, eventtime):
+        if self.completed_id == self.change_id:
+            self.write()
+        return self.reactor.NEVER
+
+    def restore(self):
+        # Called at connect, once the carriages are known
+        state = self.read()
+        self.restore_berths(state)
+        if state is None:
+            return
+        pending = state.get('pending')
+        for name, saved in state.get('carriages', {}).items():
+            topology = self.carriage_changer.topology.get(name)
+            if topology is None:
+                continue
+            carriage = topology.carriage
+            berth = self.carriage_changer.berths.get(saved.get('berth'))
+            if berth is not None and berth is not topology.berth:
+                self.carriage_changer.set_parked(
+                    self.carriage_changer.make_topology(carriage, berth))
+            # Only a calibration of the configured offsets is kept. An
+            # interrupted change leaves the calibrations valid, only the
+            # loaded carriage is unknown.
+            if not saved.get('calibrated'):
+                continue
+            if saved.get('config_offset') != list(carriage.config_offset):
+                logging.info(f'Offsets of {name} changed in the config,'
+                             ' not restoring its calibration')
+                continue
+            carriage.offset_x = saved['offset_x']
+            carriage.offset_y = saved['offset_y']
+            carriage.offset_z = saved['offset_z']
+            carriage.calibrated = True
+            self.calibrated_at[name] = saved.get('calibrated_at')
+        loaded = state.get('loaded_carriage')
+        if pending is not None:
+            logging.warning(f'Carriage change {pending} was interrupted,'
+                            ' the loaded carriage is unknown')
+        elif loaded in self.carriage_changer.topology:
+            self.carriage_changer.loaded_carriage = loaded
+            self.carriage_changer.offset_transform.set_carriage(
+                self.carriage_changer.topology[loaded].carriage)
+            self.restored_carriage = loaded
+
+    def restore_berths(self, state):
+        # With staging berths, a carriage can be parked away from its home
+        # berth. Only the state file records where, so without a complete
+        # record the carriage must be checked before any change is planned.
+        carriage_changer = self.carriage_changer
+        if not any(b.staging for b in carriage_changer.berths.values()):
+            return
+        saved = {}
+        if state is not None:
+            saved = state.get('carriages', {})
+        unknown = {name for name in carriage_changer.topology
+                   if name not in saved}
+        pending = state.get('pending') if state is not None else None
+        if pending is not None and pending.get('from') is not None:
+            unknown.add(pending['from'])
+        if unknown:
+            logging.warning('Berths of carriages %s are unknown'
+                            % (', '.join(sorted(unknown)),))
+        carriage_changer.unknown_berths = unknown
+
+    def handle_ready(self):
+        self.reactor.register_timer(self.reconcile,
+                                    self.reactor.monotonic() + self.RECONCILE_DELAY)
+
+    def reconcile(self, eventtime):
+        # A carriage held inside a dock cannot be trusted to be engaged
+        carriage_changer = self.carriage_changer
+        gcode = self.printer.lookup_object('gcode')
+        docks = {t.dock for t in carriage_changer.topology.values()}
+        if any(dock.emergency_stop.last_state for dock in docks):
+            if carriage_changer.loaded_carriage is not None:
+                gcode.respond_info(
+                    f'Not restoring {carriage_changer.loaded_carriage} as the'
+                    ' X carriage is in a dock, check it manually')
+                carriage_changer.loaded_carriage = None
+                carriage_changer.offset_transform.set_carriage(None)
+                self.write()
+        elif self.restored_carriage is not None:
+            gcode.respond_info(f'Restored {self.restored_carriage} as loaded')
+        return self.reactor.NEVER
 
 class CarriageChanger:
     def __init__(self, config):
@@ -9,8 +626,51 @@ class CarriageChanger:
         self.load_speed = float(config.get('load_speed')) * 60
         self.engage_speed = float(config.get('engage_speed')) * 60
         self.acceleration = float(config.get('acceleration') or 500)
-        self.loading_pause = config.get('loading_pause') or 1
+        self.loading_pause = float(config.get('loading_pause') or 1)
+        self.before_change_gcode = config.get('before_change_gcode', '')
+        self.loaded_carriage = None
+        # Carriages that may be parked somewhere other than their recorded
+        # berth, which must be checked before a change is planned
+        self.unknown_berths = set()
+        self.docks = {}
+        self.berths = {}
+        self.topology = types.MappingProxyType({})
+        self.topology_status = {}
+        self.default_profile = {}
+        self.motion_profile = {}
+        self.lookahead = ToolChangeLookahead(config, self)
+        self.optimizer = ToolOrderOptimizer(config, self)
+        self.telemetry = ToolChangeTelemetry(config)
+        self.state = CarriageState(config, self)
+        self.offset_transform = CarriageOffsetTransform(self.printer)
         self.printer.add_object('carriage_changer', self)
+        self.printer.register_event_handler('klippy:connect', self.handle_connect)
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command('LOAD_CARRIAGE', self.cmd_LOAD_CARRIAGE,
+                                    desc=self.cmd_LOAD_CARRIAGE_help)
+        self.gcode.register_command('UNLOAD_CARRIAGE', self.cmd_UNLOAD_CARRIAGE,
+                                    desc=self.cmd_UNLOAD_CARRIAGE_help)
+        self.gcode.register_command('UNLOAD_CARRIAGE_IF_LOADED',
+                                    self.cmd_UNLOAD_CARRIAGE_IF_LOADED,
+                                    desc=self.cmd_UNLOAD_CARRIAGE_IF_LOADED_help)
+        self.gcode.register_command('SET_LOADED_CARRIAGE',
+                                    self.cmd_SET_LOADED_CARRIAGE,
+                                    desc=self.cmd_SET_LOADED_CARRIAGE_help)
+        self.gcode.register_command('GET_LOADED_CARRIAGE',
+                                    self.cmd_GET_LOADED_CARRIAGE,
+                                    desc=self.cmd_GET_LOADED_CARRIAGE_help)
+        self.gcode.register_command('SET_OFFSET_FOR_CARRIAGE',
+                                    self.cmd_SET_OFFSET_FOR_CARRIAGE,
+                                    desc=self.cmd_SET_OFFSET_FOR_CARRIAGE_help)
+        self.gcode.register_command('SET_CARRIAGE_BERTH',
+                                    self.cmd_SET_CARRIAGE_BERTH,
+                                    desc=self.cmd_SET_CARRIAGE_BERTH_help)
+        self.gcode.register_command('SAVE_CARRIAGE_STATE',
+                                    self.cmd_SAVE_CARRIAGE_STATE,
+                                    desc=self.cmd_SAVE_CARRIAGE_STATE_help)
+        self.gcode.register_command('BENCHMARK_TOOL_CHANGES',
+                                    self.cmd_BENCHMARK_TOOL_CHANGES,
+                                    desc=self.cmd_BENCHMARK_TOOL_CHANGES_help)
         # Load carriage movement
         # pconfig = self.printer.lookup_object('configfile')
         # dirname = os.path.dirname(os.path.realpath(__file__))
@@ -22,5 +682,488 @@ class CarriageChanger:
         # for section in carriage_movement.get_prefix_sections(''):
         #     self.printer.load_object(carriage_movement, section.get_name())
 
+    def handle_connect(self):
+        self.toolhead = self.printer.lookup_object('toolhead')
+        self.set_topology(self.build_topology())
+        self.offset_transform.register()
+        self.default_profile = self.read_default_profile()
+        self.motion_profile = dict(self.default_profile)
+        self.state.restore()
+
+    def read_default_profile(self):
+        settings = self.printer.lookup_object('configfile').get_status(None)['settings']
+        profile = {}
+        for option, section, key in MOTION_PROFILE_OPTIONS:
+            if key in settings.get(section, {}):
+                profile[option] = settings[section][key]
+        profile.setdefault('square_corner_velocity', 5.)
+        return profile
+
+    def build_motion_profile(self, carriage):
+        # The carriage's own limits over the printer defaults
+        profile = dict(self.default_profile)
+        if carriage is not None:
+            for option, section, key in MOTION_PROFILE_OPTIONS:
+                value = getattr(carriage, option)
+                if value is not None and (section == 'printer'
+                                          or option in profile):
+                    profile[option] = value
+        return profile
+
+    def set_topology(self, topology):
+        self.topology = types.MappingProxyType(topology)
+        self.topology_status = {
+            name: {'berth': t.berth.name, 'dock': t.dock.name,
+                   'tool_number': t.carriage.tool_number,
+                   'align_x': t.align_x, 'engage_x': t.engage_x,
+                   'safe_y': t.safe_y, 'dock_y': t.dock_y}
+            for name, t in self.topology.items()}
+
+    def build_topology(self):
+        docks = self.docks = {
+            d.name: d for k, d in self.printer.lookup_objects(module='dock')}
+        berths = self.berths = {
+            b.name: b for k, b in self.printer.lookup_objects(module='berth')}
+        for berth in berths.values():
+            if berth.dock not in docks:
+                raise self.printer.config_error(
+                    f'Berth {berth.name} refers to unknown dock {berth.dock}')
+        for dock in docks.values():
+            dock_berths = sorted((b for b in berths.values() if b.dock == dock.name),
+                                 key=(lambda b: b.x_pos))
+            for berth, next_berth in zip(dock_berths, dock_berths[1:]):
+                if next_berth.x_pos - berth.x_pos < abs(dock.engage_xd):
+                    raise self.printer.config_error(
+                        f'Berths {berth.name} and {next_berth.name} overlap'
+                        f' in dock {dock.name}')
+        topology = {}
+        berth_carriages = {}
+        for k, carriage in self.printer.lookup_objects(module='carriage'):
+            berth = berths.get(carriage.berth)
+            if berth is None:
+                raise self.printer.config_error(
+                    f'Carriage {carriage.name} refers to unknown berth {carriage.berth}')
+            if berth.name in berth_carriages:
+                raise self.printer.config_error(
+                    f'Carriages {berth_carriages[berth.name]} and {carriage.name}'
+                    f' share berth {berth.name}')
+            berth_carriages[berth.name] = carriage.name
+            topology[carriage.name] = self.make_topology(carriage, berth)
+        return topology
+
+    def make_topology(self, carriage, berth):
+        dock = self.docks[berth.dock]
+        return CarriageTopology(
+            carriage, berth, dock, berth.x_pos - dock.engage_xd, berth.x_pos,
+            dock.safe_y, dock.safe_y + dock.load_yd)
+
+    def set_parked(self, topology):
+        # Record the berth a carriage was parked in
+        carriages = dict(self.topology)
+        carriages[topology.carriage.name] = topology
+        self.set_topology(carriages)
+        self.lookahead.next_plan = None
+
+    def choose_berth(self, unload, load):
+        # Park the unloaded carriage in whichever free berth, out of its
+        # home berth and the staging berths, makes this change quickest
+        occupied = {t.berth.name for t in self.topology.values()
+                    if t.carriage is not unload.carriage}
+        candidates = [unload]
+        for berth in self.berths.values():
+            if berth.name in occupied or berth is unload.berth:
+                continue
+            if berth.staging or berth.name == unload.carriage.berth:
+                candidates.append(self.make_topology(unload.carriage, berth))
+        position = self.toolhead.get_position()[:2]
+        return min(candidates, key=(lambda t: self.estimate_plan_time(
+            self.plan_change(t, load), position)))
+
+    def lookup_carriage(self, name):
+        topology = self.topology.get(name)
+        if topology is None:
+            raise self.gcode.error(f"Unknown carriage '{name}'")
+        return topology
+
+    def lookup_tool_change(self, carriage_name, tool_number):
+        if carriage_name is not None:
+            return self.topology.get(carriage_name)
+        for topology in self.topology.values():
+            if topology.carriage.tool_number == tool_number:
+                return topology
+        return None
+
+    def run_gcode(self, script):
+        if script:
+            self.gcode.run_script_from_command(script)
+
+    def check_in_safe_zone(self, dock):
+        self.toolhead.wait_moves()
+        if dock.emergency_stop.last_state:
+            raise self.gcode.error(
+                'Expecting X Carriage to be in safe zone, but it is in unsafe zone')
+
+    def move_to_safe_z(self):
+        if self.toolhead.get_position()[2] < self.safe_z:
+            self.toolhead.manual_move([None, None, self.safe_z],
+                                      self.toolhead.get_max_velocity()[0])
+
+    def set_acceleration(self, accel):
+        self.gcode.run_script_from_command(f'SET_VELOCITY_LIMIT ACCEL={accel:.3f}')
+
+    def set_loaded_carriage(self, carriage_name):
+        if self.loaded_carriage is not None:
+            self.gcode.respond_info(f'{self.loaded_carriage} has been unloaded')
+            self.printer.send_event('carriage_changer:unloaded_carriage',
+                                    self.loaded_carriage)
+        self.loaded_carriage = carriage_name
+        if carriage_name is not None:
+            self.gcode.respond_info(f'{carriage_name} has been loaded')
+            self.printer.send_event('carriage_changer:loaded_carriage',
+                                    carriage_name)
+
+    def apply_loaded_offset(self):
+        carriage = None
+        if self.loaded_carriage is not None:
+            carriage = self.topology[self.loaded_carriage].carriage
+        self.offset_transform.set_carriage(carriage)
+
+    def plan_change(self, unload, load):
+        # Plan the steps to unload and/or load a carriage. An unload and a
+        # load at the same dock are blended into one path that is not
+        # interrupted by safe zone checks or pauses. Going from one dock to
+        # another keeps the changer acceleration and safe Z, and the travel
+        # to the second dock is one move so its Y travel overlaps the X
+        # alignment without waiting for the first dock's moves to finish.
+        # Each dock's unsafe zone stop checks that the carriage has left
+        # the dock when it is re-armed at the end of the exchange moves.
+        exchanges = []
+        if unload is not None:
+            exchanges.append((unload, False))
+        if load is not None:
+            exchanges.append((load, True))
+        steps = []
+        for i, (topology, engage) in enumerate(exchanges):
+            blended = i > 0 and exchanges[i - 1][0].dock is topology.dock
+            if i == 0:
+                steps += self.plan_start(topology.dock)
+            elif not blended:
+                steps.append(ToolChangeStep('check_dock_clear', (topology.dock,)))
+            steps += self.plan_exchange(topology, engage, not blended)
+            if i + 1 == len(exchanges):
+                # Replaces the acceleration from before the change with the
+                # limits of the carriage now loaded, or the printer defaults
+                steps.append(ToolChangeStep(
+                    'motion_profile', (topology.carriage if engage else None,)))
+            steps += self.plan_after_exchange(topology, engage)
+        return steps
+
+    def plan_start(self, dock):
+        return [ToolChangeStep('check_safe_zone', (dock,)),
+                ToolChangeStep('gcode', (self.before_change_gcode,),
+                               'before_hooks'),
+                ToolChangeStep('offset', (None,), 'offset'),
+                ToolChangeStep('safe_z', (), 'safe_z'),
+                ToolChangeStep('acceleration', (self.acceleration,))]
+
+    def plan_exchange(self, topology, engage, settle):
+        carriage = topology.carriage
+        if engage:
+            steps = [ToolChangeStep('respond', (f'Loading {carriage.name}',)),
+                     ToolChangeStep('gcode', (carriage.before_load_gcode,),
+                                    'before_hooks'),
+                     # Align X-Carriage for loading
+                     ToolChangeStep('move', (topology.align_x, topology.safe_y),
+                                    'align')]
+        else:
+            steps = [ToolChangeStep('respond', (f'Unloading {carriage.name}',)),
+                     ToolChangeStep('gcode', (carriage.before_unload_gcode,),
+                                    'before_hooks'),
+                     # Align Carriage
+                     ToolChangeStep('move', (topology.engage_x, topology.safe_y),
+                                    'align')]
+        # Let the gantry settle after travel that did not come from this dock
+        if settle:
+            steps.append(ToolChangeStep('dwell', (self.loading_pause / 1000.,),
+                                        'align'))
+        if engage:
+            steps.append(ToolChangeStep('upcoming', (carriage.name,)))
+        # Move into the dock, engage or disengage and return to the safe zone
+        steps.append(ToolChangeStep('exchange', (topology.dock, engage),
+                                    'engage' if engage else 'extract'))
+        if not engage:
+            steps.append(ToolChangeStep('parked', (topology,)))
+        steps.append(ToolChangeStep('loaded', (carriage.name if engage else None,)))
+        return steps
+
+    def plan_after_exchange(self, topology, engage):
+        carriage = topology.carriage
+        if not engage:
+            return [ToolChangeStep('gcode', (carriage.after_unload_gcode,),
+                                   'after_hooks')]
+        return [ToolChangeStep('offset', (carriage,), 'offset'),
+                ToolChangeStep('gcode', (carriage.after_load_gcode,),
+                               'after_hooks')]
+
+    def estimate_plan_time(self, steps, position=None):
+        # Estimate how long a plan takes from the changer speeds and
+        # acceleration. Z moves and gcode hooks are not included, nor is the
+        # travel to the first dock unless the start position is given.
+        total = 0.
+        for step in steps:
+            if step.action == 'move':
+                if position is not None:
+                    distance = math.hypot(step.args[0] - position[0],
+                                          step.args[1] - position[1])
+                    total += move_time(distance, self.align_speed / 60.,
+                                       self.acceleration)
+                position = step.args
+            elif step.action == 'dwell':
+                total += step.args[0]
+            elif step.action == 'exchange':
+                moves = step.args[0].exchange_moves(step.args[1])
+                total += self.loading_pause / 1000. * (len(moves) - 1)
+                for dx, dy, speed in moves:
+                    total += move_time(math.hypot(dx, dy), speed,
+                                       self.acceleration)
+                if position is not None:
+                    position = (position[0] + sum(m[0] for m in moves),
+                                position[1] + sum(m[1] for m in moves))
+        return total
+
+    def estimate_change_time(self, from_name, to_name, position=None):
+        unload = load = None
+        if from_name is not None:
+            unload = self.lookup_carriage(from_name)
+        if to_name is not None:
+            load = self.lookup_carriage(to_name)
+        return self.estimate_plan_time(self.plan_change(unload, load), position)
+
+    def plan_load(self, topology):
+        unload = None
+        if self.loaded_carriage is not None:
+            unload = self.choose_berth(
+                self.lookup_carriage(self.loaded_carriage), topology)
+        return self.plan_change(unload, topology)
+
+    def run_plan(self, steps):
+        # Phases are timed in print time, so they measure the queued motion
+        # and any waits in the hooks rather than how long planning took.
+        # The phase boundaries are lookahead callbacks, which get their print
+        # time when the moves are flushed, so timing does not stop the moves
+        # of one phase from blending into the next.
+        if self.unknown_berths:
+            raise self.gcode.error(
+                'The berths of %s are unknown, check the docks and record'
+                ' them with SET_CARRIAGE_BERTH'
+                % (', '.join(sorted(self.unknown_berths)),))
+        loaded = [step.args[0] for step in steps if step.action == 'loaded']
+        change_id = self.state.begin_change(loaded[-1])
+        marks = []
+        def mark(phase):
+            self.toolhead.register_lookahead_callback(
+                (lambda print_time: marks.append((phase, print_time))))
+        def finish(print_time):
+            durations = collections.defaultdict(float)
+            for (phase, start_time), (unused, end_time) in zip(marks, marks[1:]):
+                if phase is not None:
+                    durations[phase] += end_time - start_time
+            durations['total'] = print_time - marks[0][1]
+            self.telemetry.record(durations)
+            self.state.complete_change(print_time, change_id)
+        mark(None)
+        for step in steps:
+            if step.phase is not None:
+                mark(step.phase)
+            getattr(self, 'step_' + step.action)(*step.args)
+            if step.phase is not None:
+                mark(None)
+        self.toolhead.register_lookahead_callback(finish)
+
+    def step_check_safe_zone(self, dock):
+        self.check_in_safe_zone(dock)
+
+    def step_gcode(self, script):
+        self.run_gcode(script)
+
+    def step_respond(self, msg):
+        self.gcode.respond_info(msg)
+
+    def step_safe_z(self):
+        self.move_to_safe_z()
+
+    def step_check_dock_clear(self, dock):
+        # The gantry is still outside this dock, so its stop is read
+        # without waiting for the moves at the previous dock to finish
+        if dock.emergency_stop.last_state:
+            raise self.gcode.error(
+                f'Expecting X Carriage to be clear of dock {dock.name}')
+
+    def step_acceleration(self, accel):
+        self.set_acceleration(accel)
+
+    def step_motion_profile(self, carriage):
+        # Apply the velocity limits and input shaper in one script
+        profile = self.build_motion_profile(carriage)
+        script = ['SET_VELOCITY_LIMIT VELOCITY=%.3f ACCEL=%.3f'
+                  ' SQUARE_CORNER_VELOCITY=%.3f' % (
+                      profile['max_velocity'], profile['max_accel'],
+                      profile['square_corner_velocity'])]
+        shaper = ['%s=%s' % (option.upper(), profile[option])
+                  for option, section, key in MOTION_PROFILE_OPTIONS
+                  if section == 'input_shaper' and option in profile]
+        if shaper:
+            script.append('SET_INPUT_SHAPER ' + ' '.join(shaper))
+        self.run_gcode('\n'.join(script))
+        self.motion_profile = profile
+
+    def step_move(self, x, y):
+        self.toolhead.manual_move([x, y], self.align_speed / 60.)
+
+    def step_dwell(self, delay):
+        self.toolhead.dwell(delay)
+
+    def step_upcoming(self, carriage_name):
+        self.printer.send_event('carriage_changer:upcoming_carriage',
+                                carriage_name)
+
+    def step_exchange(self, dock, engage):
+        dock.exchange(engage)
+
+    def step_offset(self, carriage):
+        self.offset_transform.set_carriage(carriage)
+
+    def step_parked(self, topology):
+        self.set_parked(topology)
+
+    def step_loaded(self, carriage_name):
+        self.set_loaded_carriage(carriage_name)
+
+    def load_carriage(self, topology):
+        carriage = topology.carriage
+        if carriage.name == self.loaded_carriage:
+            self.gcode.respond_info(f'{carriage.name} is already loaded')
+            return
+        plan = self.lookahead.take_plan(self.loaded_carriage, carriage.name)
+        if plan is None:
+            plan = self.plan_load(topology)
+        self.run_plan(plan)
+
+    def unload_carriage(self, topology):
+        carriage = topology.carriage
+        if carriage.name != self.loaded_carriage:
+            raise self.gcode.error(f'Cannot unload {carriage.name} because'
+                                   f' {self.loaded_carriage or "none"} is loaded')
+        self.run_plan(self.plan_change(topology, None))
+
+    def get_status(self, eventtime):
+        status = {'loaded_carriage': self.loaded_carriage or 'none',
+                  'carriages': self.topology_status,
+                  'motion_profile': self.motion_profile,
+                  'unknown_berths': sorted(self.unknown_berths)}
+        status.update(self.lookahead.get_status(eventtime))
+        status.update(self.telemetry.get_status(eventtime))
+        status.update(self.offset_transform.get_status(eventtime))
+        return status
+
+    cmd_LOAD_CARRIAGE_help = 'Load a carriage, unloading the current one first'
+    def cmd_LOAD_CARRIAGE(self, gcmd):
+        self.load_carriage(self.lookup_carriage(gcmd.get('CARRIAGE')))
+
+    cmd_UNLOAD_CARRIAGE_help = 'Unload the loaded carriage'
+    def cmd_UNLOAD_CARRIAGE(self, gcmd):
+        self.unload_carriage(self.lookup_carriage(gcmd.get('CARRIAGE')))
+
+    cmd_UNLOAD_CARRIAGE_IF_LOADED_help = 'Unload the loaded carriage, if any'
+    def cmd_UNLOAD_CARRIAGE_IF_LOADED(self, gcmd):
+        if self.loaded_carriage is not None:
+            self.unload_carriage(self.lookup_carriage(self.loaded_carriage))
+
+    cmd_SET_LOADED_CARRIAGE_help = 'Record which carriage is loaded without moving'
+    def cmd_SET_LOADED_CARRIAGE(self, gcmd):
+        carriage_name = gcmd.get('CARRIAGE')
+        if carriage_name == 'none':
+            self.set_loaded_carriage(None)
+        else:
+            self.set_loaded_carriage(self.lookup_carriage(carriage_name).carriage.name)
+        self.apply_loaded_offset()
+        self.state.write()
+
+    cmd_GET_LOADED_CARRIAGE_help = 'Report the loaded carriage'
+    def cmd_GET_LOADED_CARRIAGE(self, gcmd):
+        gcmd.respond_info(f'{self.loaded_carriage or "none"} is loaded')
+
+    cmd_SET_OFFSET_FOR_CARRIAGE_help = (
+        'Apply the offsets of the loaded carriage again after calibration')
+    def cmd_SET_OFFSET_FOR_CARRIAGE(self, gcmd):
+        carriage = self.lookup_carriage(gcmd.get('CARRIAGE')).carriage
+        if carriage.name != self.loaded_carriage:
+            gcmd.respond_info(f'{carriage.name} is not loaded, its offsets'
+                              ' will be applied when it is')
+            return
+        self.apply_loaded_offset()
+
+    cmd_SET_CARRIAGE_BERTH_help = (
+        'Record the berth a carriage is parked in after checking the docks')
+    def cmd_SET_CARRIAGE_BERTH(self, gcmd):
+        topology = self.lookup_carriage(gcmd.get('CARRIAGE'))
+        berth_name = gcmd.get('BERTH', topology.berth.name)
+        berth = self.berths.get(berth_name)
+        if berth is None:
+            raise gcmd.error(f"Unknown berth '{berth_name}'")
+        for other in self.topology.values():
+            if (other.berth is berth and other.carriage is not topology.carriage
+                    and other.carriage.name not in self.unknown_berths):
+                raise gcmd.error(f'Berth {berth.name} holds {other.carriage.name}')
+        if berth is not topology.berth:
+            self.set_parked(self.make_topology(topology.carriage, berth))
+        self.unknown_berths.discard(topology.carriage.name)
+        self.state.write()
+
+    cmd_SAVE_CARRIAGE_STATE_help = 'Save the loaded carriage and calibrations'
+    def cmd_SAVE_CARRIAGE_STATE(self, gcmd):
+        self.state.write()
+
+    def time_change(self, change, topology):
+        # The benchmark waits on each change, so it can flush the lookahead
+        start_time = self.toolhead.get_last_move_time()
+        change(topology)
+        return self.toolhead.get_last_move_time() - start_time
+
+    cmd_BENCHMARK_TOOL_CHANGES_help = (
+        'Time load and unload cycles of each carriage and report throughput')
+    def cmd_BENCHMARK_TOOL_CHANGES(self, gcmd):
+        cycles = gcmd.get_int('CYCLES', 3, minval=1)
+        carriage_name = gcmd.get('CARRIAGE', None)
+        if carriage_name is None:
+            carriages = list(self.topology.values())
+        else:
+            carriages = [self.lookup_carriage(carriage_name)]
+        loaded = self.loaded_carriage
+        if loaded is not None:
+            self.unload_carriage(self.lookup_carriage(loaded))
+        lines = ['Tool change benchmark:']
+        total_time = 0.
+        for topology in carriages:
+            load_time = unload_time = 0.
+            for i in range(cycles):
+                load_time += self.time_change(self.load_carriage, topology)
+                unload_time += self.time_change(self.unload_carriage, topology)
+            total_time += load_time + unload_time
+            predicted = (self.estimate_change_time(None, topology.carriage.name)
+                         + self.estimate_change_time(topology.carriage.name, None))
+            lines.append(f'{topology.carriage.name}: load {load_time / cycles:.2f}s'
+                         f' unload {unload_time / cycles:.2f}s'
+                         f' (predicted {predicted:.2f}s per cycle)')
+        changes = 2 * cycles * len(carriages)
+        if changes and total_time > 0.:
+            lines.append(f'{changes} changes in {total_time:.1f}s,'
+                         f' {60. * changes / total_time:.1f} changes per minute')
+        else:
+            lines.append('No changes timed')
+        if loaded is not None:
+            self.load_carriage(self.lookup_carriage(loaded))
+        gcmd.respond_info('\n'.join(lines))
+
 def load_config(config):
     return CarriageChanger(config)
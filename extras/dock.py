@@ -9,6 +9,80 @@ class Dock:
         self.unsafe_zone = config.get('unsafe_zone')
         # self.safe_zone_button = config.get('safe_zone_button')
         self.printer.add_object('dock ' + self.name, self)
+        self.printer.register_event_handler('klippy:connect', self.handle_connect)
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_mux_command('ALLOW_UNSAFE_MOVEMENT', 'DOCK', self.name,
+            self.cmd_ALLOW_UNSAFE_MOVEMENT,
+            desc=self.cmd_ALLOW_UNSAFE_MOVEMENT_help)
+        gcode.register_mux_command('RESET_SAFE_MOVEMENT', 'DOCK', self.name,
+            self.cmd_RESET_SAFE_MOVEMENT,
+            desc=self.cmd_RESET_SAFE_MOVEMENT_help)
+        gcode.register_mux_command('DOCK_EXCHANGE', 'DOCK', self.name,
+            self.cmd_DOCK_EXCHANGE,
+            desc=self.cmd_DOCK_EXCHANGE_help)
+
+    def handle_connect(self):
+        self.toolhead = self.printer.lookup_object('toolhead')
+        self.emergency_stop = self.printer.lookup_object(
+            'emergency_stop ' + self.unsafe_zone)
+
+    def set_y_position(self, y):
+        pos = self.toolhead.get_position()
+        pos[1] = y
+        self.toolhead.set_position(pos)
+
+    def allow_unsafe_movement(self):
+        # Suppress the unsafe zone stop from the end of the queued moves
+        self.set_y_position(0 - self.load_yd)
+        self.emergency_stop.suppress_from(self.toolhead.get_last_move_time())
+
+    def reset_safe_movement(self):
+        # Arm the unsafe zone stop from the end of the queued moves
+        self.emergency_stop.arm_from(self.toolhead.get_last_move_time())
+        self.set_y_position(self.safe_y)
+
+    def exchange_moves(self, engage):
+        # Relative (dx, dy, speed) moves into the dock, to engage or
+        # disengage the carriage and back out, with a pause between each
+        carriage_changer = self.printer.lookup_object('carriage_changer')
+        align_speed = carriage_changer.align_speed / 60.
+        load_speed = carriage_changer.load_speed / 60.
+        engage_speed = carriage_changer.engage_speed / 60.
+        if engage:
+            in_speed, out_speed, engage_xd = align_speed, load_speed, self.engage_xd
+        else:
+            in_speed, out_speed, engage_xd = load_speed, align_speed, -self.engage_xd
+        return [(0., self.load_yd, in_speed),
+                (engage_xd, 0., engage_speed),
+                (0., -self.load_yd, out_speed)]
+
+    def exchange(self, engage):
+        # Move into the dock, engage or disengage the carriage and move back
+        # out. The unsafe zone stop is only suppressed between the print
+        # times at which these moves start and finish.
+        carriage_changer = self.printer.lookup_object('carriage_changer')
+        pause = float(carriage_changer.loading_pause) / 1000.
+        self.allow_unsafe_movement()
+        pos = self.toolhead.get_position()
+        for i, (dx, dy, speed) in enumerate(self.exchange_moves(engage)):
+            if i:
+                self.toolhead.dwell(pause)
+            pos[0] += dx
+            pos[1] += dy
+            self.toolhead.move(pos, speed)
+        self.reset_safe_movement()
+
+    cmd_ALLOW_UNSAFE_MOVEMENT_help = 'Allow movement into the dock'
+    def cmd_ALLOW_UNSAFE_MOVEMENT(self, gcmd):
+        self.allow_unsafe_movement()
+
+    cmd_RESET_SAFE_MOVEMENT_help = 'Protect the dock from movement again'
+    def cmd_RESET_SAFE_MOVEMENT(self, gcmd):
+        self.reset_safe_movement()
+
+    cmd_DOCK_EXCHANGE_help = 'Engage or disengage a carriage in the dock'
+    def cmd_DOCK_EXCHANGE(self, gcmd):
+        self.exchange(gcmd.get_int('ENGAGE', 1, minval=0, maxval=1))
 
 
 def load_config_prefix(config):
@@ -1,12 +1,58 @@
-import logging
+import collections, logging
+from . import background_writer
+
+# Group of emergency stops that must agree before triggering a shutdown.
+# A stop on its own is a group of one that needs a single vote.
+class EmergencyStopVote:
+    def __init__(self, printer, name, votes_required):
+        self.printer = printer
+        self.name = name
+        self.votes_required = votes_required
+        self.stops = []
+    def add_stop(self, stop):
+        self.stops.append(stop)
+    def check_votes(self):
+        voting = [s.name for s in self.stops if s.voting]
+        if len(voting) < self.votes_required:
+            return False
+        self.printer.invoke_shutdown(
+            f'Shutdown due to emergency stop {", ".join(voting)}!')
+        return True
 
 class EmergencyStop:
+    ARM_CHECK_INTERVAL = 0.05
+
     def __init__(self, config):
         self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.mcu = self.printer.lookup_object('mcu')
         self.name = config.get_name().split(' ')[-1]
         self.pin = config.get('pin')
         self.enabled = config.getboolean('enabled', True)
+        self.debounce_time = config.getfloat('debounce_time', 0., minval=0.)
         self.last_state = 0
+        # Set once the stop has been pressed for longer than debounce_time
+        self.voting = False
+        self.journal = collections.deque(
+            maxlen=config.getint('journal_size', 100, minval=1))
+        self.chatter_time = config.getfloat('chatter_time', 0.05, minval=0.)
+        journal_path = config.get('journal_path', None)
+        self.journal_writer = None
+        if journal_path is not None:
+            self.journal_writer = background_writer.BackgroundWriter(
+                journal_path)
+        self.flushed_time = 0.
+        self.press_time = self.release_time = self.disable_time = None
+        self.press_count = self.chatter_count = 0
+        self.last_press_duration = 0.
+        self.last_disabled_duration = self.longest_disabled_duration = 0.
+        # Print time window [start, end] in which the stop is suppressed
+        self.suppressed_window = None
+        self.debounce_timer = self.reactor.register_timer(self.debounce_done)
+        # Checks a stop still pressed when its suppression ends, as a press
+        # is otherwise only seen on an edge
+        self.arm_timer = self.reactor.register_timer(self.arm_done)
+        self.vote = self.setup_vote(config)
         buttons = self.printer.load_object(config, 'buttons')
         if config.get('analog_range', None) is None:
             buttons.register_buttons([self.pin], self.button_callback)
@@ -26,6 +72,40 @@ class EmergencyStop:
         self.gcode.register_mux_command('DISABLE_EMERGENCY_STOP', 'EMERGENCY_STOP', self.name,
             self.cmd_DISABLE_EMERGENCY_STOP,
             desc=self.cmd_DISABLE_EMERGENCY_STOP_help)
+        self.gcode.register_mux_command('DUMP_EMERGENCY_JOURNAL', 'EMERGENCY_STOP', self.name,
+            self.cmd_DUMP_EMERGENCY_JOURNAL,
+            desc=self.cmd_DUMP_EMERGENCY_JOURNAL_help)
+        self.printer.register_event_handler('klippy:shutdown',
+                                            self.handle_shutdown)
+        self.printer.register_event_handler('klippy:connect',
+                                            self.handle_connect)
+
+    def handle_connect(self):
+        # Every stop in the group has been loaded by now
+        if len(self.vote.stops) < self.vote.votes_required:
+            raise self.printer.config_error(
+                f'votes_required for emergency stop {self.name} is more than'
+                f' the {len(self.vote.stops)} stops in vote group'
+                f' {self.vote.name}')
+
+    def setup_vote(self, config):
+        group = self.vote_group = config.get('vote_group', None)
+        votes_required = config.getint('votes_required', 1, minval=1)
+        if group is None:
+            vote = EmergencyStopVote(self.printer, self.name, votes_required)
+        else:
+            for k, stop in self.printer.lookup_objects(module='emergency_stop'):
+                if stop.vote_group == group:
+                    vote = stop.vote
+                    break
+            else:
+                vote = EmergencyStopVote(self.printer, group, votes_required)
+            if vote.votes_required != votes_required:
+                raise config.error(
+                    f'votes_required for emergency stop {self.name} does not'
+                    f' match the other stops in vote group {group}')
+        vote.add_stop(self)
+        return vote
 
     cmd_QUERY_EMERGENCY_help = 'Report on the state of an emergency stop'
     def cmd_QUERY_EMERGENCY(self, gcmd):
@@ -34,29 +114,173 @@ class EmergencyStop:
 
     cmd_ENABLE_EMERGENCY_STOP_help = 'Enable the emergency stop'
     def cmd_ENABLE_EMERGENCY_STOP(self, gcmd):
+        eventtime = self.reactor.monotonic()
+        if not self.enabled:
+            self.record(eventtime, 'enabled')
+            if self.disable_time is not None:
+                self.track_disabled_duration(eventtime - self.disable_time)
         self.enabled = True
+        self.suppressed_window = None
         gcmd.respond_info(f'emergency stop {self.name} enabled!')
 
     cmd_DISABLE_EMERGENCY_STOP_help = 'Disable the emergency stop'
     def cmd_DISABLE_EMERGENCY_STOP(self, gcmd):
+        eventtime = self.reactor.monotonic()
+        if self.enabled:
+            self.record(eventtime, 'disabled')
+            self.disable_time = eventtime
         self.enabled = False
+        self.voting = False
+        self.reactor.update_timer(self.debounce_timer, self.reactor.NEVER)
+        self.reactor.update_timer(self.arm_timer, self.reactor.NEVER)
         gcmd.respond_info(f'emergency stop {self.name} disabled!')
 
+    cmd_DUMP_EMERGENCY_JOURNAL_help = 'Report and save the emergency stop journal'
+    def cmd_DUMP_EMERGENCY_JOURNAL(self, gcmd):
+        lines = [self.format_entry(e) for e in self.journal]
+        gcmd.respond_info('\n'.join([f'emergency stop {self.name} journal:']
+                                    + lines))
+        self.flush_journal()
+
     def button_callback(self, eventtime, state):
+        # Trigger the shutdown before doing any console output
         self.last_state = state
-        gcode = self.printer.lookup_object('gcode')
+        if not state:
+            self.track_release(eventtime)
+            self.voting = False
+            self.reactor.update_timer(self.debounce_timer, self.reactor.NEVER)
+        else:
+            self.track_press(eventtime)
+            if self.is_armed(eventtime):
+                self.press_armed(eventtime)
+        self.reactor.register_callback((lambda e: self.report_state(state)))
+
+    def debounce_done(self, eventtime):
+        if self.last_state and self.is_armed(eventtime):
+            self.cast_vote()
+        return self.reactor.NEVER
+
+    def arm_done(self, eventtime):
+        if not self.enabled:
+            return self.reactor.NEVER
+        if self.suppressed_window is not None and not self.is_armed(eventtime):
+            # The moves have not reached the end of the suppression yet
+            return eventtime + self.ARM_CHECK_INTERVAL
+        if self.last_state and self.is_armed(eventtime):
+            self.record(eventtime, 'pressed when armed')
+            self.press_armed(eventtime)
+        return self.reactor.NEVER
+
+    def press_armed(self, eventtime):
+        if self.debounce_time:
+            self.reactor.update_timer(self.debounce_timer,
+                                      eventtime + self.debounce_time)
+        else:
+            self.cast_vote()
+
+    def suppress_from(self, print_time):
+        # Suppress the stop from print_time until arm_from() is called
+        self.suppressed_window = [print_time, None]
+        self.record(self.reactor.monotonic(), f'suppressed from {print_time:.6f}')
+
+    def arm_from(self, print_time):
+        # Enable the stop, ending any suppression at print_time
+        eventtime = self.reactor.monotonic()
+        if self.suppressed_window is not None:
+            start_time = self.suppressed_window[0]
+            self.suppressed_window[1] = print_time
+            self.track_disabled_duration(print_time - start_time)
+        self.record(eventtime, f'armed from {print_time:.6f}')
+        self.enabled = True
+        # Check the state once the moves reach print_time, without waiting
+        # for them here
+        delay = max(0., print_time - self.mcu.estimated_print_time(eventtime))
+        self.reactor.update_timer(self.arm_timer, eventtime + delay)
+
+    def is_armed(self, eventtime):
+        if not self.enabled:
+            return False
+        if self.suppressed_window is None:
+            return True
+        start_time, end_time = self.suppressed_window
+        print_time = self.mcu.estimated_print_time(eventtime)
+        if print_time < start_time:
+            return True
+        if end_time is None or print_time <= end_time:
+            return False
+        self.suppressed_window = None
+        return True
+
+    def cast_vote(self):
+        self.voting = True
+        self.vote.check_votes()
+
+    def report_state(self, state):
         if state:
-            gcode.respond_info(f'emergency stop {self.name} activated!')
-            if self.enabled:
-                self.printer.invoke_shutdown(f'Shutdown due to emergency stop {self.name}!')
+            msg = f'emergency stop {self.name} activated!'
         else:
-            gcode.respond_info(f'emergency stop {self.name} deactivated!')
+            msg = f'emergency stop {self.name} deactivated!'
+        logging.info(msg)
+        self.gcode.respond_info(msg)
+
+    def track_press(self, eventtime):
+        self.record(eventtime, 'pressed')
+        self.press_count += 1
+        if (self.release_time is not None
+                and eventtime - self.release_time < self.chatter_time):
+            self.chatter_count += 1
+        self.press_time = eventtime
 
+    def track_release(self, eventtime):
+        self.record(eventtime, 'released')
+        if self.press_time is not None:
+            self.last_press_duration = eventtime - self.press_time
+        self.release_time = eventtime
+
+    def track_disabled_duration(self, duration):
+        self.last_disabled_duration = duration
+        self.longest_disabled_duration = max(self.longest_disabled_duration,
+                                             duration)
+
+    def record(self, eventtime, event):
+        self.journal.append((eventtime, event))
+
+    def format_entry(self, entry):
+        eventtime, event = entry
+        return f'{eventtime:.6f} {self.name} {event}'
+
+    def flush_journal(self):
+        # Only hand entries that have not been written yet to the writer
+        if self.journal_writer is None:
+            return
+        lines = [self.format_entry(e) for e in self.journal
+                 if e[0] > self.flushed_time]
+        if lines:
+            self.flushed_time = self.journal[-1][0]
+            self.journal_writer.append(lines)
+
+    def handle_shutdown(self):
+        if self.voting:
+            self.record(self.reactor.monotonic(), 'tripped')
+        self.flush_journal()
 
     def get_status(self, eventtime=None):
+        status = {
+            'press_count': self.press_count,
+            'chatter_count': self.chatter_count,
+            'last_press_duration': self.last_press_duration,
+            'last_disabled_duration': self.last_disabled_duration,
+            'longest_disabled_duration': self.longest_disabled_duration,
+            'journal_length': len(self.journal),
+            'last_event': None}
+        # The full journal is only reported by DUMP_EMERGENCY_JOURNAL
+        if self.journal:
+            status['last_event'] = list(self.journal[-1])
         if self.last_state:
-            return {'state': 'PRESSED'}
-        return {'state': 'RELEASED'}
+            status['state'] = 'PRESSED'
+        else:
+            status['state'] = 'RELEASED'
+        return status
 
 def load_config_prefix(config):
     return EmergencyStop(config)
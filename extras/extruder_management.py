@@ -1,8 +1,767 @@
+import collections, json, logging, math, os, time
+from . import background_writer, multi_axis_probe
+
+# Filament in an extruder, with the colour as (r, g, b) from 0 to 1. Either
+# may be None when it is not known.
+Filament = collections.namedtuple('Filament', ['color', 'material'])
+
+def parse_color(text):
+    text = text.strip().lstrip('#')
+    if len(text) != 6:
+        raise ValueError(f'Colour {text} is not in the form RRGGBB')
+    return tuple(int(text[i:i + 2], 16) / 255. for i in (0, 2, 4))
+
+def luminance(color):
+    r, g, b = color
+    return 0.2126 * r + 0.7152 * g + 0.0722 * b
+
+# Cleaning that a load needs, from least to most
+CLEAN_NONE = 'none'
+CLEAN_BRUSH = 'brush'
+CLEAN_PURGE = 'purge'
+CLEAN_FULL = 'full'
+
+# What an extruder has done since it was last cleaned
+class ExtruderHistory:
+    def __init__(self):
+        # None until the extruder has been cleaned
+        self.clean_time = None
+        self.clean_position = 0.
+        # Set while the extruder is parked
+        self.unload_time = None
+        self.unload_temperature = 0.
+        # Time spent parked hot enough to ooze since the last purge
+        self.ooze_time = 0.
+
+# Heater states kept by the standby manager
+HEATER_ACTIVE = 'active'
+HEATER_STANDBY = 'standby'
+HEATER_OFF = 'off'
+
+# Print temperature of an extruder and the timer that drops it to standby,
+# then off, while it is parked
+class ExtruderTemperature:
+    def __init__(self, manager, extruder):
+        self.manager = manager
+        self.heater = extruder.get_heater()
+        self.target = 0.
+        self.state = HEATER_ACTIVE
+        # Target last set by the timer, to tell if anything changed it since
+        self.applied = None
+        self.timer = manager.reactor.register_timer(self.handle_timer)
+
+    def set_target(self, target):
+        self.target = target
+        self.state = HEATER_ACTIVE
+        self.applied = None
+        self.cancel()
+
+    def schedule(self, waketime):
+        self.manager.reactor.update_timer(self.timer, waketime)
+
+    def cancel(self):
+        self.schedule(self.manager.reactor.NEVER)
+
+    def restore(self):
+        # Heat back to the print temperature, unless the heater has been set
+        # by something else since it was dropped
+        self.cancel()
+        if self.state == HEATER_ACTIVE:
+            return
+        eventtime = self.manager.reactor.monotonic()
+        if self.heater.get_temp(eventtime)[1] == self.applied:
+            self.heater.set_temp(self.target)
+        self.state = HEATER_ACTIVE
+        self.applied = None
+
+    def handle_timer(self, eventtime):
+        current_target = self.heater.get_temp(eventtime)[1]
+        if self.applied is not None and current_target != self.applied:
+            return self.manager.reactor.NEVER
+        if self.state == HEATER_ACTIVE:
+            self.state = HEATER_STANDBY
+            self.applied = min(current_target, max(
+                0., self.target - self.manager.standby_temperature_drop))
+            next_time = self.manager.off_delay
+        else:
+            self.state = HEATER_OFF
+            self.applied = 0.
+            next_time = 0.
+        self.heater.set_temp(self.applied)
+        if not next_time:
+            return self.manager.reactor.NEVER
+        return eventtime + next_time
+
+    def get_status(self, eventtime):
+        return {'target': self.target, 'state': self.state}
+
+def fit_scale(xs, ys):
+    # Least squares fit of y = scale * x
+    sxx = sum(x * x for x in xs)
+    if not sxx:
+        raise ValueError('Need at least one non-zero value to fit a scale')
+    return sum(x * y for x, y in zip(xs, ys)) / sxx
+
+def fit_line(xs, ys):
+    # Least squares fit of y = slope * x + intercept
+    if not xs:
+        raise ValueError('Need at least two different values to fit a line')
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    sxx = sum((x - mean_x) ** 2 for x in xs)
+    if not sxx:
+        raise ValueError('Need at least two different values to fit a line')
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sxx
+    return slope, mean_y - slope * mean_x
+
+# Test wall printed by the extrusion calibration. Flow walls are printed at
+# one speed with a flow multiplier. Pressure advance walls are printed slow
+# then fast with pressure_advance set, so the width just after the speed
+# change shows whether the pressure advance is too low or too high.
+CalibrationWall = collections.namedtuple(
+    'CalibrationWall', ['x', 'y', 'flow', 'pressure_advance'])
+
+# Prints test walls with each extruder, measures their width with the probe
+# carriage and fits the rotation distance and pressure advance of each
+# extruder. The results are saved to calibration_path and applied again at
+# startup.
+class ExtrusionCalibration:
+    # Wall layout in mm. The walls of the first extruder start MARGIN inside
+    # the bed mesh and each further extruder gets its own row in Y.
+    WALL_LENGTH = 30.
+    WALL_SPACING = 15.
+    MARGIN = 20.
+    LAYERS = 10
+    # Line width and layer height as a fraction of the nozzle diameter
+    LINE_WIDTH_RATIO = 1.125
+    LAYER_HEIGHT_RATIO = 0.375
+    # Distance after the speed change at which the width is measured, and
+    # from the wall at which the probe goes down beside it
+    TRANSITION_OFFSET = 2.
+    PROBE_CLEARANCE = 5.
+    def __init__(self, config, manager):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.manager = manager
+        self.writer = None
+        self.path = config.get('calibration_path', None)
+        if self.path is not None:
+            self.writer = background_writer.BackgroundWriter(self.path)
+            self.path = self.writer.path
+        self.temperature = config.getfloat('calibration_temperature', 220.,
+                                           above=0.)
+        self.speed = config.getfloat('calibration_speed', 20., above=0.)
+        self.fast_speed = config.getfloat('calibration_fast_speed', 80.,
+                                          above=0.)
+        self.flows = config.getfloatlist('calibration_flows', (0.9, 1., 1.1))
+        self.pressure_advances = config.getfloatlist(
+            'calibration_pressure_advances', (0., 0.04, 0.08))
+        self.probe_carriage = config.get('calibration_probe_carriage',
+                                         'bed_probe')
+        self.probe_width = config.getfloat('calibration_probe_width',
+                                           5.81632812873522, above=0.)
+        self.results = self.read()
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command('CALIBRATE_EXTRUSION',
+                                    self.cmd_CALIBRATE_EXTRUSION,
+                                    desc=self.cmd_CALIBRATE_EXTRUSION_help)
+        if self.results:
+            self.printer.register_event_handler('klippy:ready',
+                                                self.handle_ready)
+
+    def read(self):
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            logging.exception(f'Unable to read extrusion calibration {self.path}')
+            return {}
+
+    def write(self):
+        if self.writer is not None:
+            self.writer.replace(json.dumps(self.results, indent=2))
+
+    def handle_ready(self):
+        self.reactor.register_timer(self.apply_saved, self.reactor.NOW)
+
+    def apply_saved(self, eventtime):
+        for name, result in self.results.items():
+            if self.manager.lookup_extruder(name) is None:
+                continue
+            try:
+                self.gcode.run_script(self.apply_script(name, result))
+            except Exception:
+                logging.exception(f'Unable to apply extrusion calibration'
+                                  f' for {name}')
+        return self.reactor.NEVER
+
+    def apply_script(self, name, result):
+        return ('SET_EXTRUDER_ROTATION_DISTANCE EXTRUDER=%s DISTANCE=%.6f\n'
+                'SET_PRESSURE_ADVANCE EXTRUDER=%s ADVANCE=%.6f' % (
+                    name, result['rotation_distance'],
+                    name, result['pressure_advance']))
+
+    def run_gcode(self, script):
+        self.gcode.run_script_from_command(script)
+
+    def get_settings(self, section):
+        settings = self.printer.lookup_object('configfile').get_status(
+            None)['settings']
+        return settings.get(section, {})
+
+    def line_width(self, name):
+        return self.get_settings(name)['nozzle_diameter'] * self.LINE_WIDTH_RATIO
+
+    def layer_height(self, name):
+        return (self.get_settings(name)['nozzle_diameter']
+                * self.LAYER_HEIGHT_RATIO)
+
+    def wall_height(self, name):
+        return self.LAYERS * self.layer_height(name)
+
+    def extrusion_per_mm(self, name, flow):
+        filament_area = math.pi * (
+            self.get_settings(name)['filament_diameter'] / 2.) ** 2
+        return (self.line_width(name) * self.layer_height(name) * flow
+                / filament_area)
+
+    def plan_walls(self, row):
+        mesh_min = self.get_settings('bed_mesh').get('mesh_min', (0., 0.))
+        x = mesh_min[0] + self.MARGIN
+        y = mesh_min[1] + self.MARGIN + row * (self.WALL_LENGTH + self.MARGIN)
+        specs = ([(flow, None) for flow in self.flows]
+                 + [(1., pa) for pa in self.pressure_advances])
+        return [CalibrationWall(x + i * self.WALL_SPACING, y, flow, pa)
+                for i, (flow, pa) in enumerate(specs)]
+
+    def print_walls(self, name, walls, temperature, pressure_advance):
+        carriage = self.printer.lookup_object('carriage ' + name)
+        toolhead = self.printer.lookup_object('toolhead')
+        travel_speed = toolhead.get_max_velocity()[0] * 60.
+        script = [f"CLEAN_EXTRUDER CARRIAGE='{name}' S='{temperature}'",
+                  f'M109 S{temperature} T{carriage.tool_number}',
+                  'ADVANCE_INTO_HOT_ZONE',
+                  'SAVE_GCODE_STATE NAME=EXTRUSION_CALIBRATION_STATE',
+                  'G90', 'M83']
+        half_length = self.WALL_LENGTH / 2.
+        layer_height = self.layer_height(name)
+        for layer in range(self.LAYERS):
+            z = layer_height * (layer + 1)
+            for wall in walls:
+                advance = wall.pressure_advance
+                if advance is None:
+                    advance = pressure_advance
+                e = self.extrusion_per_mm(name, wall.flow) * half_length
+                script += [
+                    f'G0 Z{z + 1.:.3f} F{travel_speed:.0f}',
+                    f'G0 X{wall.x:.3f} Y{wall.y:.3f}',
+                    f'G0 Z{z:.3f}',
+                    f'SET_PRESSURE_ADVANCE EXTRUDER={name} ADVANCE={advance:.6f}',
+                    f'G1 Y{wall.y + half_length:.3f} E{e:.5f}'
+                    f' F{self.speed * 60.:.0f}']
+                fast_speed = self.speed
+                if wall.pressure_advance is not None:
+                    fast_speed = self.fast_speed
+                script.append(f'G1 Y{wall.y + self.WALL_LENGTH:.3f} E{e:.5f}'
+                              f' F{fast_speed * 60.:.0f}')
+        script += [
+            f'SET_PRESSURE_ADVANCE EXTRUDER={name} ADVANCE={pressure_advance:.6f}',
+            f'G0 Z{self.wall_height(name) + 5.:.3f} F{travel_speed:.0f}',
+            'RESTORE_GCODE_STATE NAME=EXTRUSION_CALIBRATION_STATE']
+        self.run_gcode('\n'.join(script))
+
+    def measure_width(self, gcmd, name, x, y):
+        # Touch the wall from the right and then from the left, halfway up
+        probe = self.printer.lookup_object('probe')
+        above = self.wall_height(name) + 2.
+        probe_z = self.wall_height(name) / 2.
+        right_x = x + self.PROBE_CLEARANCE
+        left_x = x - self.PROBE_CLEARANCE
+        toolhead = self.printer.lookup_object('toolhead')
+        travel_speed = toolhead.get_max_velocity()[0] * 60.
+        self.run_gcode(f'G90\nG0 Z{above:.3f} F{travel_speed:.0f}\n'
+                       f'G0 X{right_x:.3f} Y{y:.3f}\nG0 Z{probe_z:.3f}')
+        right = multi_axis_probe.run_single_probe(probe, gcmd, 'x-')[0]
+        self.run_gcode(f'G0 X{right_x:.3f}\nG0 Z{above:.3f}\n'
+                       f'G0 X{left_x:.3f}\nG0 Z{probe_z:.3f}')
+        left = multi_axis_probe.run_single_probe(probe, gcmd, 'x+')[0]
+        self.run_gcode(f'G0 X{left_x:.3f}\nG0 Z{above:.3f}')
+        return right - left - self.probe_width
+
+    def measure_walls(self, gcmd, name, walls):
+        # Return [(wall, steady width, width after the speed change)]
+        measurements = []
+        for wall in walls:
+            steady = self.measure_width(
+                gcmd, name, wall.x, wall.y + self.WALL_LENGTH * 0.75)
+            transition = None
+            if wall.pressure_advance is not None:
+                transition = self.measure_width(
+                    gcmd, name, wall.x,
+                    wall.y + self.WALL_LENGTH / 2. + self.TRANSITION_OFFSET)
+            measurements.append((wall, steady, transition))
+        return measurements
+
+    def fit(self, line_width, rotation_distance, pressure_advance,
+            measurements):
+        # The steady widths scale with the filament actually extruded, so
+        # the rotation distance scales with them. The width just after the
+        # speed change falls short of the steady width while the pressure
+        # advance is too low and overshoots once it is too high.
+        scale = fit_scale([wall.flow * line_width
+                           for wall, steady, transition in measurements],
+                          [steady for wall, steady, transition in measurements])
+        advances = [(wall.pressure_advance, transition / steady - 1.)
+                    for wall, steady, transition in measurements
+                    if transition is not None]
+        if len({advance for advance, error in advances}) >= 2:
+            slope, intercept = fit_line(*zip(*advances))
+            if slope:
+                pressure_advance = max(0., -intercept / slope)
+        return rotation_distance * scale, pressure_advance
+
+    def calibrate(self, gcmd, names, temperature):
+        eventtime = self.reactor.monotonic()
+        rows = []
+        for row, name in enumerate(names):
+            extruder = self.manager.lookup_extruder(name)
+            rotation_distance = (
+                extruder.extruder_stepper.stepper.get_rotation_distance()[0])
+            pressure_advance = extruder.get_status(eventtime)['pressure_advance']
+            walls = self.plan_walls(row)
+            gcmd.respond_info(f'Printing extrusion test walls with {name}')
+            self.print_walls(name, walls, temperature, pressure_advance)
+            rows.append((name, walls, rotation_distance, pressure_advance))
+        self.run_gcode(f"LOAD_CARRIAGE CARRIAGE='{self.probe_carriage}'")
+        for name, walls, rotation_distance, pressure_advance in rows:
+            measurements = self.measure_walls(gcmd, name, walls)
+            rotation_distance, pressure_advance = self.fit(
+                self.line_width(name), rotation_distance, pressure_advance,
+                measurements)
+            result = {'rotation_distance': rotation_distance,
+                      'pressure_advance': pressure_advance,
+                      'widths': [steady for wall, steady, transition
+                                 in measurements],
+                      'calibrated_at': time.time()}
+            self.results[name] = result
+            self.run_gcode(self.apply_script(name, result))
+            gcmd.respond_info(
+                f'{name} rotation_distance: {rotation_distance:.6f}'
+                f' pressure_advance: {pressure_advance:.6f}')
+        self.run_gcode('MOVE_TO_SAFE_Z')
+        self.write()
+
+    def get_status(self, eventtime):
+        return {'extrusion_calibration': dict(self.results)}
+
+    cmd_CALIBRATE_EXTRUSION_help = (
+        'Fit the rotation distance and pressure advance of one or all extruders')
+    def cmd_CALIBRATE_EXTRUSION(self, gcmd):
+        carriage_name = gcmd.get('CARRIAGE', None)
+        if carriage_name is None:
+            carriage_changer = self.printer.lookup_object('carriage_changer')
+            names = sorted(
+                (name for name in carriage_changer.topology
+                 if self.manager.lookup_extruder(name) is not None),
+                key=lambda name: int(
+                    carriage_changer.topology[name].carriage.tool_number))
+        elif self.manager.lookup_extruder(carriage_name) is None:
+            raise gcmd.error(f'{carriage_name} is not an extruder')
+        else:
+            names = [carriage_name]
+        temperature = gcmd.get_float('TEMPERATURE', self.temperature, above=0.)
+        try:
+            self.calibrate(gcmd, names, temperature)
+        except ValueError as e:
+            raise gcmd.error(str(e))
+
 class ExtruderManagement:
     def __init__(self, config):
         self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        # purge_length is used when too little is known about a change of
+        # extruder, min_purge_length when reloading the same filament
         self.purge_length = float(config.get('purge_length') or 10)
+        self.min_purge_length = config.getfloat(
+            'min_purge_length', 1., minval=0., maxval=self.purge_length)
+        self.material_change_purge_length = config.getfloat(
+            'material_change_purge_length', 5., minval=0.)
+        self.short_purge_length = config.getfloat('short_purge_length', 2.,
+                                                  minval=0.)
+        # A change of extruder only forces a purge past this length
+        self.transition_purge_threshold = config.getfloat(
+            'transition_purge_threshold', self.short_purge_length, minval=0.)
+        self.purge_lengths = {}
+        for from_name, to_name, length in config.getlists(
+                'purge_lengths', (), seps=(',', '\n'), count=3):
+            try:
+                self.purge_lengths[(from_name, to_name)] = float(length)
+            except ValueError:
+                raise config.error(f'Invalid purge length {length} from'
+                                   f' {from_name} to {to_name}')
+        self.filaments = {}
+        for filament in config.getlists('filaments', (), seps=(',', '\n')):
+            if len(filament) not in (2, 3):
+                raise config.error(f'Filament {",".join(filament)} should be'
+                                   f' extruder, colour[, material]')
+            try:
+                self.filaments[filament[0]] = Filament(
+                    parse_color(filament[1]),
+                    filament[2] if len(filament) == 3 else None)
+            except ValueError as e:
+                raise config.error(str(e))
+        # The last extruder unloaded and the purge for the current one
+        self.previous_extruder = None
+        self.purge = {'from': 'none', 'to': 'none', 'length': self.purge_length}
+        # Limits past which a load needs cleaning
+        self.clean_extruded_length = config.getfloat(
+            'clean_extruded_length', 1000., minval=0.)
+        self.clean_interval = config.getfloat('clean_interval', 600., minval=0.)
+        self.ooze_temperature = config.getfloat('ooze_temperature', 170.)
+        self.ooze_idle_time = config.getfloat('ooze_idle_time', 60., minval=0.)
+        # Parked extruders drop to standby after standby_delay, and turn off
+        # off_delay after that. Zero disables either.
+        self.standby_temperature_drop = config.getfloat(
+            'standby_temperature_drop', 0., minval=0.)
+        self.standby_delay = config.getfloat('standby_delay', 30., minval=0.)
+        self.off_delay = config.getfloat('off_delay', 0., minval=0.)
+        self.temperatures = {}
+        self.histories = {}
+        self.last_cleaning = {}
         self.printer.add_object('extruder_management', self)
+        self.calibration = ExtrusionCalibration(config, self)
+        self.printer.register_event_handler(
+            'carriage_changer:unloaded_carriage', self.handle_unloaded)
+        self.printer.register_event_handler(
+            'carriage_changer:loaded_carriage', self.handle_loaded)
+        self.printer.register_event_handler(
+            'carriage_changer:upcoming_carriage', self.handle_upcoming)
+        self.printer.register_event_handler('klippy:connect', self.handle_connect)
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command('CLEAN_EXTRUDER_IF_NEEDED',
+                                    self.cmd_CLEAN_EXTRUDER_IF_NEEDED,
+                                    desc=self.cmd_CLEAN_EXTRUDER_IF_NEEDED_help)
+        self.gcode.register_command('SET_EXTRUDER_FILAMENT',
+                                    self.cmd_SET_EXTRUDER_FILAMENT,
+                                    desc=self.cmd_SET_EXTRUDER_FILAMENT_help)
+        self.gcode.register_command('RECORD_EXTRUDER_CLEANED',
+                                    self.cmd_RECORD_EXTRUDER_CLEANED,
+                                    desc=self.cmd_RECORD_EXTRUDER_CLEANED_help)
+
+    def handle_connect(self):
+        self.carriage_changer = self.printer.lookup_object('carriage_changer')
+        # Replace the M104 and M109 of [extruder] so that they manage every
+        # extruder's temperature. The extruders are only created after the
+        # extras are loaded, so this is done at connect as for a
+        # gcode_macro's rename_existing.
+        for cmd, func in (('M104', self.cmd_M104), ('M109', self.cmd_M109)):
+            self.gcode.register_command(cmd, None)
+            self.gcode.register_command(cmd, func)
+
+    def lookup_extruder(self, carriage_name):
+        # Extruder carriages share their name with their extruder
+        extruder = self.printer.lookup_object(carriage_name, None)
+        if not hasattr(extruder, 'get_heater'):
+            return None
+        return extruder
+
+    def get_temperature(self, carriage_name):
+        if carriage_name not in self.temperatures:
+            extruder = self.lookup_extruder(carriage_name)
+            if extruder is None:
+                return None
+            self.temperatures[carriage_name] = ExtruderTemperature(self, extruder)
+        return self.temperatures[carriage_name]
+
+    def set_temperature(self, carriage_name, temperature, wait=False):
+        # Heating other extruders carries on while this one is waited on
+        extruder_temperature = self.get_temperature(carriage_name)
+        extruder_temperature.set_target(temperature)
+        pheaters = self.printer.lookup_object('heaters')
+        pheaters.set_temperature(extruder_temperature.heater, temperature, wait)
+
+    def schedule_standby(self, extruder_temperature):
+        if (extruder_temperature.target and self.standby_delay
+                and self.standby_temperature_drop):
+            extruder_temperature.schedule(
+                self.reactor.monotonic() + self.standby_delay)
+
+    def preheat(self, carriage_name, temperature=None):
+        # Bring a parked extruder back up ahead of its tool change
+        extruder_temperature = self.get_temperature(carriage_name)
+        if extruder_temperature is None:
+            return
+        if temperature and temperature != extruder_temperature.target:
+            extruder_temperature.set_target(temperature)
+            extruder_temperature.heater.set_temp(temperature)
+        else:
+            extruder_temperature.restore()
+
+    def handle_upcoming(self, carriage_name):
+        self.preheat(carriage_name)
+
+    def get_history(self, carriage_name):
+        if carriage_name not in self.histories:
+            self.histories[carriage_name] = ExtruderHistory()
+        return self.histories[carriage_name]
+
+    def handle_unloaded(self, carriage_name):
+        extruder = self.lookup_extruder(carriage_name)
+        if extruder is None:
+            return
+        self.previous_extruder = carriage_name
+        eventtime = self.reactor.monotonic()
+        history = self.get_history(carriage_name)
+        history.unload_time = eventtime
+        history.unload_temperature = extruder.get_heater().get_temp(eventtime)[0]
+        self.schedule_standby(self.get_temperature(carriage_name))
+
+    def handle_loaded(self, carriage_name):
+        if self.lookup_extruder(carriage_name) is not None:
+            self.get_temperature(carriage_name).restore()
+            self.purge = {
+                'from': self.previous_extruder or 'none', 'to': carriage_name,
+                'length': self.calc_purge_length(self.previous_extruder,
+                                                 carriage_name)}
+        history = self.histories.get(carriage_name)
+        if history is None or history.unload_time is None:
+            return
+        if history.unload_temperature >= self.ooze_temperature:
+            history.ooze_time += self.reactor.monotonic() - history.unload_time
+        history.unload_time = None
+
+    def calc_purge_length(self, from_name, to_name):
+        # Light filament after dark needs the most purging to hide the dark,
+        # and a change of material needs a little more on top
+        length = self.purge_lengths.get((from_name, to_name))
+        if length is not None:
+            return length
+        if from_name is None:
+            return self.purge_length
+        if from_name == to_name:
+            return self.min_purge_length
+        old = self.filaments.get(from_name, Filament(None, None))
+        new = self.filaments.get(to_name, Filament(None, None))
+        if old.color is None or new.color is None:
+            length = self.purge_length
+        else:
+            lightening = max(0., luminance(new.color) - luminance(old.color))
+            difference = max(abs(a - b) for a, b in zip(old.color, new.color))
+            weight = min(1., lightening + 0.5 * difference)
+            length = (self.min_purge_length
+                      + (self.purge_length - self.min_purge_length) * weight)
+        if (old.material is not None and new.material is not None
+                and old.material.upper() != new.material.upper()):
+            length += self.material_change_purge_length
+        return length
+
+    def extruded_since_clean(self, carriage_name):
+        extruder = self.lookup_extruder(carriage_name)
+        history = self.histories.get(carriage_name)
+        if extruder is None or history is None:
+            return 0.
+        return extruder.last_position - history.clean_position
+
+    def transition_source(self, carriage_name):
+        # The extruder changed from, before or after this one loads
+        if self.purge['to'] == carriage_name:
+            return None if self.purge['from'] == 'none' else self.purge['from']
+        from_name = self.carriage_changer.loaded_carriage
+        if self.lookup_extruder(from_name or '') is None:
+            from_name = self.previous_extruder
+        return from_name
+
+    def transition_purge_length(self, carriage_name):
+        # The purge for changing to this extruder, before or after it loads
+        if self.purge['to'] == carriage_name:
+            return self.purge['length']
+        return self.calc_purge_length(self.transition_source(carriage_name),
+                                      carriage_name)
+
+    def filaments_differ(self, from_name, to_name):
+        # Only a known difference of colour or material counts
+        old = self.filaments.get(from_name, Filament(None, None))
+        new = self.filaments.get(to_name, Filament(None, None))
+        if (old.color is not None and new.color is not None
+                and old.color != new.color):
+            return True
+        return (old.material is not None and new.material is not None
+                and old.material.upper() != new.material.upper())
+
+    def needs_transition_purge(self, carriage_name):
+        # Reloading the same extruder, or one with a compatible filament, is
+        # left to the ooze and brush limits
+        from_name = self.transition_source(carriage_name)
+        if from_name is None or from_name == carriage_name:
+            return False
+        if ((from_name, carriage_name) not in self.purge_lengths
+                and not self.filaments_differ(from_name, carriage_name)):
+            return False
+        return (self.transition_purge_length(carriage_name)
+                > self.transition_purge_threshold)
+
+    def choose_cleaning(self, carriage_name):
+        history = self.get_history(carriage_name)
+        if history.clean_time is None:
+            return CLEAN_FULL
+        needs_brush = (
+            self.extruded_since_clean(carriage_name) >= self.clean_extruded_length
+            or self.reactor.monotonic() - history.clean_time >= self.clean_interval)
+        # A change of filament colour or material gets the purge its
+        # transition needs
+        needs_purge = (history.ooze_time >= self.ooze_idle_time
+                       or self.needs_transition_purge(carriage_name))
+        if needs_brush and needs_purge:
+            return CLEAN_FULL
+        if needs_brush:
+            return CLEAN_BRUSH
+        if needs_purge:
+            return CLEAN_PURGE
+        return CLEAN_NONE
+
+    def clean(self, carriage_name, cleaning, temperature, end_position=None):
+        # Clean along one path from the dock exit, over the brush and on to
+        # end_position, so the travel, purge and brush passes are queued
+        # back to back instead of each starting from the safe position
+        carriage_changer = self.carriage_changer
+        if carriage_changer.loaded_carriage != carriage_name:
+            carriage = carriage_changer.lookup_carriage(carriage_name).carriage
+            self.gcode.run_script_from_command(
+                f'M104 S{temperature} T{carriage.tool_number}\n'
+                f"LOAD_CARRIAGE CARRIAGE='{carriage_name}'")
+        heat = f"HEAT_EXTRUDER CARRIAGE='{carriage_name}' S='{temperature}'"
+        if cleaning == CLEAN_NONE:
+            self.gcode.run_script_from_command(heat)
+            return
+        brush = self.printer.lookup_object('brush')
+        retraction = self.printer.lookup_object('retraction')
+        toolhead = self.printer.lookup_object('toolhead')
+        gcode_move = self.printer.lookup_object('gcode_move')
+        max_velocity = toolhead.get_max_velocity()[0]
+        # Lower the bed below the brush before travelling to it
+        pos = gcode_move.position_with_transform()
+        if pos[2] < brush.safe_z_pos_for_brush:
+            pos[2] = brush.safe_z_pos_for_brush
+            gcode_move.move_with_transform(list(pos), max_velocity)
+        pos[:2] = [brush.brush_x_pos, brush.brush_y_pos]
+        gcode_move.move_with_transform(list(pos), max_velocity)
+        gcode_move.reset_last_position()
+        # The brush opens when the toolhead gets there, and the heater is
+        # only waited on once the travel is queued
+        self.gcode.run_script_from_command('OPEN_BRUSH\n' + heat)
+        if cleaning in (CLEAN_PURGE, CLEAN_FULL):
+            length = max(self.short_purge_length, self.purge['length'])
+            retraction.advance_into_hot_zone()
+            retraction.move_extruder(
+                length, retraction.firmware_retraction.unretract_speed)
+            brush.brush('wipe', 1)
+            retraction.retract_from_hot_zone()
+        if cleaning in (CLEAN_BRUSH, CLEAN_FULL):
+            brush.brush(brush.brush_pattern, brush.brush_passes)
+        self.gcode.run_script_from_command('CLOSE_BRUSH')
+        if end_position is None:
+            self.gcode.run_script_from_command('MOVE_TO_SAFE_ORIGIN')
+            return
+        pos = gcode_move.position_with_transform()
+        pos[:2] = end_position
+        gcode_move.move_with_transform(pos, max_velocity)
+        gcode_move.reset_last_position()
+
+    def record_cleaned(self, carriage_name, cleaning):
+        history = self.get_history(carriage_name)
+        if cleaning in (CLEAN_PURGE, CLEAN_FULL):
+            history.ooze_time = 0.
+        if cleaning in (CLEAN_BRUSH, CLEAN_FULL):
+            history.clean_time = self.reactor.monotonic()
+            extruder = self.lookup_extruder(carriage_name)
+            if extruder is not None:
+                history.clean_position = extruder.last_position
+        self.last_cleaning[carriage_name] = cleaning
+
+    def get_status(self, eventtime):
+        extruders = {}
+        for carriage_name, history in self.histories.items():
+            since_clean = None
+            if history.clean_time is not None:
+                since_clean = eventtime - history.clean_time
+            extruders[carriage_name] = {
+                'extruded_since_clean': self.extruded_since_clean(carriage_name),
+                'time_since_clean': since_clean,
+                'ooze_time': history.ooze_time,
+                'last_cleaning': self.last_cleaning.get(carriage_name, CLEAN_NONE)}
+        filaments = {name: {'color': filament.color,
+                            'material': filament.material}
+                     for name, filament in self.filaments.items()}
+        temperatures = {name: t.get_status(eventtime)
+                        for name, t in self.temperatures.items()}
+        status = {'extruders': extruders, 'filaments': filaments,
+                  'purge': dict(self.purge), 'temperatures': temperatures}
+        status.update(self.calibration.get_status(eventtime))
+        return status
+
+    def lookup_tool_extruder(self, gcmd):
+        # Extruder named by T, as for [extruder], or else the loaded one
+        index = gcmd.get_int('T', None, minval=0)
+        if index is None:
+            carriage_name = self.carriage_changer.loaded_carriage
+            if self.lookup_extruder(carriage_name or '') is None:
+                gcmd.respond_info('Ignoring extruder temperature because'
+                                  ' extruder is not specified')
+                return None
+            return carriage_name
+        carriage_name = 'extruder' if index == 0 else 'extruder%d' % (index,)
+        if self.lookup_extruder(carriage_name) is None:
+            if gcmd.get_float('S', 0.) <= 0.:
+                return None
+            raise gcmd.error('Extruder not configured')
+        return carriage_name
+
+    def cmd_M104(self, gcmd, wait=False):
+        temperature = gcmd.get_float('S', 0.)
+        carriage_name = self.lookup_tool_extruder(gcmd)
+        if carriage_name is not None:
+            self.set_temperature(carriage_name, temperature, wait)
+
+    def cmd_M109(self, gcmd):
+        self.cmd_M104(gcmd, wait=True)
+
+    cmd_CLEAN_EXTRUDER_IF_NEEDED_help = (
+        'Brush, purge or fully clean an extruder, depending on its history')
+    def cmd_CLEAN_EXTRUDER_IF_NEEDED(self, gcmd):
+        carriage_name = gcmd.get('CARRIAGE')
+        temperature = gcmd.get_float('S', 0.)
+        end_position = None
+        if gcmd.get('X', None) is not None or gcmd.get('Y', None) is not None:
+            end_position = [gcmd.get_float('X'), gcmd.get_float('Y')]
+        cleaning = self.choose_cleaning(carriage_name)
+        if cleaning == CLEAN_NONE:
+            gcmd.respond_info(f'Extruder {carriage_name} does not need cleaning')
+        else:
+            gcmd.respond_info(f'Cleaning extruder {carriage_name} ({cleaning})')
+        self.clean(carriage_name, cleaning, temperature, end_position)
+        self.record_cleaned(carriage_name, cleaning)
+
+    cmd_SET_EXTRUDER_FILAMENT_help = (
+        'Set the colour and material of the filament in an extruder')
+    def cmd_SET_EXTRUDER_FILAMENT(self, gcmd):
+        carriage_name = gcmd.get('CARRIAGE')
+        filament = self.filaments.get(carriage_name, Filament(None, None))
+        color = gcmd.get('COLOR', None)
+        if color is not None:
+            try:
+                filament = filament._replace(color=parse_color(color))
+            except ValueError as e:
+                raise gcmd.error(str(e))
+        material = gcmd.get('MATERIAL', None)
+        if material is not None:
+            filament = filament._replace(material=material)
+        self.filaments[carriage_name] = filament
+
+    cmd_RECORD_EXTRUDER_CLEANED_help = 'Record that an extruder has been cleaned'
+    def cmd_RECORD_EXTRUDER_CLEANED(self, gcmd):
+        self.record_cleaned(gcmd.get('CARRIAGE'), CLEAN_FULL)
 
 
 def load_config(config):
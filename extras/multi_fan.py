@@ -15,12 +15,24 @@ class MultiFan:
         self.fan = fan.Fan(config)
         self.name = config.get_name()
         self.fan_name = self.name.split()[-1]
+        min_speed_change = config.getfloat('min_speed_change', 0.,
+                                           minval=0., maxval=1.)
+        min_update_interval = config.getfloat('min_update_interval', 0.,
+                                              minval=0.)
+        carriage = config.get('carriage', None)
+        spin_up_speed = config.getfloat('spin_up_speed', 1.,
+                                        minval=0., maxval=1.)
+        spin_up_time = config.getfloat('spin_up_time', 0., minval=0.)
 
         for k,f in config.get_printer().lookup_objects(module='multi_fan'):
             self.controller = f.controller
             break
         else:
             self.controller = MultiFanController(config)
+        self.controller.register_fan(self.fan, min_speed_change,
+                                     min_update_interval)
+        self.controller.register_spin_up_profile(self.fan, carriage,
+                                                 spin_up_speed, spin_up_time)
         self.controller.activate_fan_if_not_present(self.fan)
 
         gcode = config.get_printer().lookup_object('gcode')
@@ -38,11 +50,31 @@ class MultiFan:
 
 class MultiFanController:
     def __init__(self, config):
+        self.printer = config.get_printer()
         self.active_fan = None
         self.requested_speed = None
-        gcode = config.get_printer().lookup_object('gcode')
+        # Speed and print_time of the last update sent to each fan
+        self.sent_speeds = {}
+        self.sent_times = {}
+        self.fan_limits = {}
+        self.spin_up_profiles = {}
+        self.carriage_fans = {}
+        # Fans spun up ahead of a carriage load that are not yet active
+        self.prespun_fans = set()
+        gcode = self.printer.lookup_object('gcode')
         gcode.register_command("M106", self.cmd_M106)
         gcode.register_command("M107", self.cmd_M107)
+        self.printer.register_event_handler(
+            'carriage_changer:upcoming_carriage', self.prespin_carriage_fan)
+        gcode.register_command("PRESPIN_CARRIAGE_FAN",
+                               self.cmd_PRESPIN_CARRIAGE_FAN,
+                               desc=self.cmd_PRESPIN_CARRIAGE_FAN_help)
+    def register_fan(self, fan, min_speed_change, min_update_interval):
+        self.fan_limits[fan] = (min_speed_change, min_update_interval)
+    def register_spin_up_profile(self, fan, carriage, speed, time):
+        self.spin_up_profiles[fan] = (speed, time)
+        if carriage is not None:
+            self.carriage_fans[carriage] = fan
     def activate_fan_if_not_present(self, fan):
         if not self.active_fan:
             self.active_fan = fan
@@ -50,21 +82,79 @@ class MultiFanController:
         # Set new active fan and move the set speed to that fan.
         if self.active_fan == fan:
             return
+        updates = {}
         if self.active_fan and self.requested_speed is not None:
-            self.active_fan.set_speed_from_command(0.)
+            updates[self.active_fan] = 0.
+        for prespun_fan in self.prespun_fans:
+            updates[prespun_fan] = 0.
+        self.prespun_fans.clear()
         self.active_fan = fan
         if self.active_fan and self.requested_speed is not None:
-            self.active_fan.set_speed_from_command(self.requested_speed)
+            updates[self.active_fan] = self.requested_speed
+        # The handover goes out as a single queued update
+        self.queue_speeds(updates)
+    def request_speed(self, speed):
+        self.requested_speed = speed
+        if self.active_fan:
+            self.queue_speeds({self.active_fan: speed})
+    def is_redundant(self, fan, speed):
+        last_speed = self.sent_speeds.get(fan)
+        if last_speed is None:
+            return False
+        if speed == last_speed:
+            return True
+        # Always honour switching a fan fully on or off
+        if not speed or not last_speed or speed >= 1.:
+            return False
+        min_speed_change = self.fan_limits[fan][0]
+        return abs(speed - last_speed) < min_speed_change
+    def prespin_carriage_fan(self, carriage_name):
+        fan = self.carriage_fans.get(carriage_name)
+        if fan is not None:
+            self.prespin_fan(fan)
+    def prespin_fan(self, fan):
+        # Bring an upcoming fan to the requested speed before it is
+        # activated, kicking it with its spin up profile first
+        speed = self.requested_speed
+        if fan == self.active_fan or not speed:
+            return
+        if self.is_redundant(fan, speed):
+            return
+        self.prespun_fans.add(fan)
+        spin_up_speed, spin_up_time = self.spin_up_profiles[fan]
+        if spin_up_time and spin_up_speed > speed:
+            self.queue_updates([(fan, spin_up_speed, 0.),
+                                (fan, speed, spin_up_time)])
+        else:
+            self.queue_updates([(fan, speed, 0.)])
+    def queue_speeds(self, updates):
+        self.queue_updates([(f, s, 0.) for f, s in updates.items()
+                            if not self.is_redundant(f, s)])
+    def queue_updates(self, updates):
+        if not updates:
+            return
+        for fan, speed, delay in updates:
+            self.sent_speeds[fan] = speed
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.register_lookahead_callback(
+            (lambda pt: self._apply_updates(pt, updates)))
+    def _apply_updates(self, print_time, updates):
+        for fan, speed, delay in updates:
+            # Rate limit PWM changes on each fan
+            min_update_interval = self.fan_limits[fan][1]
+            fan_time = max(print_time + delay, self.sent_times.get(fan, 0.)
+                           + min_update_interval)
+            self.sent_times[fan] = fan_time
+            fan.set_speed(print_time=fan_time, value=speed)
     def cmd_M106(self, gcmd):
         # Set fan speed
-        self.requested_speed = gcmd.get_float('S', 255., minval=0.) / 255.
-        if self.active_fan:
-            self.active_fan.set_speed_from_command(self.requested_speed)
+        self.request_speed(gcmd.get_float('S', 255., minval=0.) / 255.)
     def cmd_M107(self, gcmd):
         # Turn fan off
-        self.requested_speed = 0.
-        if self.active_fan:
-            self.active_fan.set_speed_from_command(self.requested_speed)
+        self.request_speed(0.)
+    cmd_PRESPIN_CARRIAGE_FAN_help = 'Spin up the fan of an upcoming carriage'
+    def cmd_PRESPIN_CARRIAGE_FAN(self, gcmd):
+        self.prespin_carriage_fan(gcmd.get('CARRIAGE'))
 
 def load_config_prefix(config):
     return MultiFan(config)
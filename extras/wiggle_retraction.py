@@ -1,3 +1,17 @@
+import collections, json, logging, math, os, time
+from . import background_writer
+
+# Filament pulled out of an extruder's hot zone, with the time and nozzle
+# temperature when it was pulled out
+HotZoneRetraction = collections.namedtuple(
+    'HotZoneRetraction', ['length', 'time', 'temperature'])
+
+# Retraction states
+IDLE = 'idle'
+PENDING = 'pending'
+RETRACTED = 'retracted'
+Z_HOPPED = 'z_hopped'
+
 class WiggleRetraction:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -10,7 +24,349 @@ class WiggleRetraction:
         # self.retract_speed = float(config.get('retract_speed') or 100)
         self.unretract_dwell = float(config.get('unretract_dwell') or 0.1)
         # self.unretract_speed = float(config.get('unretract_speed') or 100)
+        # Relative X/Y moves of the wipe square that follows the retract move
+        half_wiggle = self.retract_xy_wiggle / 2
+        self.wipe_moves = ((half_wiggle, 0.), (0., self.retract_xy_wiggle),
+                           (-self.retract_xy_wiggle, 0.),
+                           (0., -self.retract_xy_wiggle), (half_wiggle, 0.))
+        # 'square' wipes in place, 'travel' wipes along the next travel move
+        self.wipe_mode = config.getchoice(
+            'wipe_mode', {'square': 'square', 'travel': 'travel'}, 'square')
+        # Z hop added to moves by the transform in 'travel' mode
+        self.z_hop_offset = 0.
+        self.next_transform = None
+        self.state = IDLE
+        self.retracted_length = 0.
+        # Gcode Z height after the Z hop, while in the Z_HOPPED state
+        self.z_hop_height = None
+        # The filament is pushed back at hot_zone_advance_speed until the last
+        # hot_zone_melt_length, which goes at the unretract speed scaled by
+        # how hot the nozzle still is. Each minute parked adds
+        # hot_zone_ooze_rate, up to hot_zone_max_extra_length, for ooze.
+        self.hot_zone_advance_speed = config.getfloat(
+            'hot_zone_advance_speed', None, above=0.)
+        self.hot_zone_melt_length = config.getfloat(
+            'hot_zone_melt_length', 5., minval=0.)
+        self.hot_zone_ooze_rate = config.getfloat(
+            'hot_zone_ooze_rate', 0., minval=0.)
+        self.hot_zone_max_extra_length = config.getfloat(
+            'hot_zone_max_extra_length', 2., minval=0.)
+        # Retraction from the hot zone, by extruder name. It is saved to
+        # hot_zone_state_path so that it survives a restart. Without a saved
+        # state the extruders in hot_zone_known are the only ones known not
+        # to be retracted, and None means they all are.
+        self.hot_zone_retracted = {}
+        self.hot_zone_known = set()
+        self.hot_zone_writer = None
+        state_path = config.get('hot_zone_state_path', None)
+        if state_path is not None:
+            self.hot_zone_writer = background_writer.BackgroundWriter(state_path)
+            self.read_hot_zone_state()
         self.printer.add_object('retraction', self)
+        # Retraction lengths and speeds stay with firmware_retraction so that
+        # SET_RETRACTION keeps working, but its G10/G11 are replaced
+        self.firmware_retraction = self.printer.load_object(
+            config, 'firmware_retraction')
+        self.printer.register_event_handler('klippy:connect', self.handle_connect)
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command('G10', None)
+        self.gcode.register_command('G11', None)
+        self.gcode.register_command('G10', self.cmd_RETRACT,
+                                    desc=self.cmd_RETRACT_help)
+        self.gcode.register_command('G11', self.cmd_UNRETRACT,
+                                    desc=self.cmd_UNRETRACT_help)
+        self.gcode.register_command('RETRACT', self.cmd_RETRACT,
+                                    desc=self.cmd_RETRACT_help)
+        self.gcode.register_command('UNRETRACT', self.cmd_UNRETRACT,
+                                    desc=self.cmd_UNRETRACT_help)
+        self.gcode.register_command('UNRETRACT_WITHOUT_Z',
+                                    self.cmd_UNRETRACT_WITHOUT_Z,
+                                    desc=self.cmd_UNRETRACT_WITHOUT_Z_help)
+        self.gcode.register_command('RETRACT_FROM_HOT_ZONE',
+                                    self.cmd_RETRACT_FROM_HOT_ZONE,
+                                    desc=self.cmd_RETRACT_FROM_HOT_ZONE_help)
+        self.gcode.register_command('ADVANCE_INTO_HOT_ZONE',
+                                    self.cmd_ADVANCE_INTO_HOT_ZONE,
+                                    desc=self.cmd_ADVANCE_INTO_HOT_ZONE_help)
+
+    def handle_connect(self):
+        self.toolhead = self.printer.lookup_object('toolhead')
+        self.gcode_move = self.printer.lookup_object('gcode_move')
+        if self.wipe_mode == 'travel':
+            self.next_transform = self.gcode_move.set_move_transform(
+                self, force=True)
+
+    def sync_gcode_position(self, e_distance):
+        # The moves went straight to the toolhead, so update the gcode
+        # position while leaving the gcode E coordinate where it was
+        self.gcode_move.reset_last_position()
+        self.gcode_move.base_position[3] += e_distance
+
+    def update_state(self):
+        # The Z hop is lost once the gcode has moved Z away from it, unless
+        # it is applied by the transform
+        if (self.state == Z_HOPPED and not self.z_hop_offset
+                and self.gcode_move.last_position[2] != self.z_hop_height):
+            self.state = RETRACTED
+            self.z_hop_height = None
+
+    def retract(self):
+        # Retract while lifting by retract_z, then wipe a square around the
+        # nozzle at full speed
+        if self.state != IDLE:
+            return
+        if self.wipe_mode == 'travel':
+            # Wait for the next move to see which way to wipe
+            self.state = PENDING
+            return
+        pos = self.toolhead.get_position()
+        retract_length = self.firmware_retraction.retract_length
+        pos[1] -= self.retract_xy_wiggle / 2
+        pos[2] += self.retract_z
+        pos[3] -= retract_length
+        self.toolhead.move(list(pos), self.firmware_retraction.retract_speed)
+        max_velocity = self.toolhead.get_max_velocity()[0]
+        for dx, dy in self.wipe_moves:
+            pos[0] += dx
+            pos[1] += dy
+            self.toolhead.move(list(pos), max_velocity)
+        self.sync_gcode_position(-retract_length)
+        self.state = Z_HOPPED
+        self.retracted_length = retract_length
+        self.z_hop_height = self.gcode_move.last_position[2]
+
+    def unretract(self, lower_z):
+        self.advance_into_hot_zone()
+        self.update_state()
+        if self.state == PENDING:
+            # Nothing has moved since the retract, so there is nothing to undo
+            self.state = IDLE
+            return
+        if self.state == IDLE:
+            return
+        pos = self.toolhead.get_position()
+        unretract_length = (self.retracted_length
+                            + self.firmware_retraction.unretract_extra_length)
+        # The gcode position never included a transform Z hop, so that is
+        # always undone
+        if self.z_hop_offset:
+            pos[2] -= self.z_hop_offset
+            self.z_hop_offset = 0.
+        elif lower_z and self.state == Z_HOPPED:
+            pos[2] -= self.retract_z
+        pos[3] += unretract_length
+        self.toolhead.move(pos, self.firmware_retraction.unretract_speed)
+        self.toolhead.dwell(self.unretract_dwell)
+        self.sync_gcode_position(unretract_length)
+        self.state = IDLE
+        self.retracted_length = 0.
+        self.z_hop_height = None
+
+    def get_position(self):
+        pos = self.next_transform.get_position()
+        if self.z_hop_offset:
+            pos[2] -= self.z_hop_offset
+        return pos
+
+    def move(self, newpos, speed):
+        if self.state == PENDING:
+            self.retract_into_move(newpos, speed)
+            return
+        if self.z_hop_offset:
+            newpos = list(newpos)
+            newpos[2] += self.z_hop_offset
+        self.next_transform.move(newpos, speed)
+
+    def retract_into_move(self, newpos, speed):
+        # Retract and hop over the first retract_xy_wiggle of a travel move,
+        # wiping along the travel direction, then finish the travel at the
+        # hopped height. The two moves are collinear so lookahead blends
+        # them. Any other move gets the retract and hop in place first.
+        start = self.next_transform.get_position()
+        retract_length = self.firmware_retraction.retract_length
+        retract_speed = self.firmware_retraction.retract_speed
+        dx, dy = newpos[0] - start[0], newpos[1] - start[1]
+        distance = math.hypot(dx, dy)
+        e_pos = start[3] - retract_length
+        if not distance or newpos[3] != start[3]:
+            pos = list(start)
+            pos[2] += self.retract_z
+            pos[3] = e_pos
+            self.next_transform.move(pos, retract_speed)
+            end = list(newpos)
+            end[2] += self.retract_z
+            end[3] -= retract_length
+            self.next_transform.move(end, speed)
+        else:
+            wipe = min(self.retract_xy_wiggle, distance)
+            ratio = wipe / distance
+            # Keep the extruder within its retract speed
+            wipe_speed = speed
+            if retract_length > 0.:
+                wipe_speed = min(speed, retract_speed * wipe / retract_length)
+            pos = [start[0] + dx * ratio, start[1] + dy * ratio,
+                   start[2] + (newpos[2] - start[2]) * ratio + self.retract_z,
+                   e_pos] + list(newpos[4:])
+            self.next_transform.move(pos, wipe_speed)
+            if ratio < 1.:
+                end = [newpos[0], newpos[1], newpos[2] + self.retract_z,
+                       e_pos] + list(newpos[4:])
+                self.next_transform.move(end, speed)
+        self.z_hop_offset = self.retract_z
+        self.state = Z_HOPPED
+        self.retracted_length = retract_length
+        self.sync_gcode_position(-retract_length)
+        self.z_hop_height = self.gcode_move.last_position[2]
+
+    def get_hot_extruder(self):
+        extruder = self.toolhead.get_extruder()
+        if not hasattr(extruder, 'get_heater'):
+            return None
+        if not extruder.get_heater().can_extrude:
+            return None
+        return extruder
+
+    def move_extruder(self, distance, speed):
+        pos = self.toolhead.get_position()
+        pos[3] += distance
+        self.toolhead.move(pos, speed)
+        self.sync_gcode_position(distance)
+
+    def read_hot_zone_state(self):
+        path = self.hot_zone_writer.path
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as f:
+                state = json.load(f)
+            # Parked times are saved as wall clock times
+            eventtime = self.printer.get_reactor().monotonic()
+            now = time.time()
+            self.hot_zone_retracted = {
+                name: HotZoneRetraction(r['length'],
+                                        eventtime - (now - r['time']),
+                                        r['temperature'])
+                for name, r in state.items()}
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            logging.exception(f'Unable to read hot zone state {path}')
+            return
+        self.hot_zone_known = None
+
+    def write_hot_zone_state(self):
+        if self.hot_zone_writer is None:
+            return
+        eventtime = self.printer.get_reactor().monotonic()
+        now = time.time()
+        state = {name: {'length': r.length,
+                        'time': now - (eventtime - r.time),
+                        'temperature': r.temperature}
+                 for name, r in self.hot_zone_retracted.items()}
+        self.hot_zone_writer.replace(json.dumps(state, indent=2))
+
+    def set_hot_zone_known(self, name):
+        if self.hot_zone_known is not None:
+            self.hot_zone_known.add(name)
+
+    def retract_from_hot_zone(self):
+        # Pull the filament out of the hot zone so it does not ooze while
+        # the carriage is parked
+        extruder = self.get_hot_extruder()
+        if extruder is None or extruder.get_name() in self.hot_zone_retracted:
+            return
+        self.gcode.respond_info('Retracting from hot zone')
+        self.move_extruder(-self.hot_zone_retract_length,
+                           self.firmware_retraction.retract_speed)
+        eventtime = self.printer.get_reactor().monotonic()
+        self.hot_zone_retracted[extruder.get_name()] = HotZoneRetraction(
+            self.hot_zone_retract_length, eventtime,
+            extruder.get_heater().get_temp(eventtime)[0])
+        self.set_hot_zone_known(extruder.get_name())
+        self.write_hot_zone_state()
+
+    def plan_hot_zone_advance(self, extruder, retraction):
+        # Return [(length, speed)] moves to push the filament back into the
+        # hot zone, as fast as the nozzle can melt it
+        eventtime = self.printer.get_reactor().monotonic()
+        parked_minutes = (eventtime - retraction.time) / 60.
+        extra_length = min(self.hot_zone_ooze_rate * parked_minutes,
+                           self.hot_zone_max_extra_length)
+        length = retraction.length + extra_length
+        unretract_speed = self.firmware_retraction.unretract_speed
+        if self.hot_zone_advance_speed is None:
+            return [(length, unretract_speed)]
+        heater = extruder.get_heater()
+        temperature = heater.get_temp(eventtime)[0]
+        melt_speed = unretract_speed
+        if temperature < retraction.temperature:
+            # The nozzle has cooled while parked, so it melts more slowly
+            min_temp = heater.min_extrude_temp
+            ratio = ((temperature - min_temp)
+                     / max(retraction.temperature - min_temp, 1.))
+            melt_speed *= min(1., max(0.1, ratio))
+        melt_length = min(self.hot_zone_melt_length, length)
+        moves = [(length - melt_length, self.hot_zone_advance_speed),
+                 (melt_length, melt_speed)]
+        return [(l, v) for l, v in moves if l > 0.]
+
+    def advance_into_hot_zone(self, length=None):
+        # Push the filament back in after retract_from_hot_zone, or by length
+        # when it is given
+        if (not self.hot_zone_retracted and length is None
+                and self.hot_zone_known is None):
+            return
+        extruder = self.get_hot_extruder()
+        if extruder is None:
+            return
+        name = extruder.get_name()
+        retraction = self.hot_zone_retracted.pop(name, None)
+        if length is not None:
+            moves = [(length, self.firmware_retraction.unretract_speed)]
+        elif retraction is not None:
+            moves = self.plan_hot_zone_advance(extruder, retraction)
+        else:
+            if self.hot_zone_known is not None and name not in self.hot_zone_known:
+                self.gcode.respond_info(
+                    f'Hot zone retraction of {name} is unknown since the'
+                    ' restart, use ADVANCE_INTO_HOT_ZONE LENGTH= if it was'
+                    ' retracted')
+                self.set_hot_zone_known(name)
+            return
+        self.gcode.respond_info('Advancing into hot zone')
+        for move_length, speed in moves:
+            self.move_extruder(move_length, speed)
+        self.set_hot_zone_known(name)
+        self.write_hot_zone_state()
+
+    def get_status(self, eventtime):
+        self.update_state()
+        return {'state': self.state,
+                'retracted_length': self.retracted_length,
+                'z_hop_height': self.z_hop_height,
+                'hot_zone_retracted': {
+                    name: {'length': r.length,
+                           'parked_time': eventtime - r.time,
+                           'temperature': r.temperature}
+                    for name, r in self.hot_zone_retracted.items()}}
+
+    cmd_RETRACT_help = 'Retract and wipe'
+    def cmd_RETRACT(self, gcmd):
+        self.retract()
+
+    cmd_UNRETRACT_help = 'Unretract and undo the Z hop'
+    def cmd_UNRETRACT(self, gcmd):
+        self.unretract(True)
+
+    cmd_UNRETRACT_WITHOUT_Z_help = 'Unretract without moving Z'
+    def cmd_UNRETRACT_WITHOUT_Z(self, gcmd):
+        self.unretract(False)
+
+    cmd_RETRACT_FROM_HOT_ZONE_help = 'Retract the filament out of the hot zone'
+    def cmd_RETRACT_FROM_HOT_ZONE(self, gcmd):
+        self.retract_from_hot_zone()
+
+    cmd_ADVANCE_INTO_HOT_ZONE_help = 'Advance the filament back into the hot zone'
+    def cmd_ADVANCE_INTO_HOT_ZONE(self, gcmd):
+        self.advance_into_hot_zone(gcmd.get_float('LENGTH', None, above=0.))
 
 
 def load_config(config):
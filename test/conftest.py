@@ -0,0 +1,11 @@
+import os, sys
+
+# The extras are imported as the extras package of this repository, and the
+# klippy modules they use from the Klipper checkout that install.sh links
+# them into
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KLIPPY_PATH = os.path.join(
+    os.path.expanduser(os.environ.get('KLIPPER_PATH', '~/klipper')), 'klippy')
+for path in (ROOT, KLIPPY_PATH):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,115 @@
+# Just enough of the klippy printer, config and reactor to load the extras
+# without a printer attached
+
+class FakeError(Exception):
+    pass
+
+class FakeReactor:
+    NOW = 0.
+    NEVER = 9999999999999999.
+
+    def __init__(self):
+        self.now = 0.
+
+    def monotonic(self):
+        return self.now
+
+    def pause(self, waketime):
+        return self.now
+
+    def register_timer(self, callback, waketime=NEVER):
+        return [callback, waketime]
+
+    def update_timer(self, timer, waketime):
+        timer[1] = waketime
+
+class FakeGCode:
+    error = FakeError
+
+    def __init__(self):
+        self.commands = {}
+        self.responses = []
+
+    def register_command(self, cmd, func, desc=None):
+        self.commands[cmd] = func
+
+    def respond_info(self, msg):
+        self.responses.append(msg)
+
+class FakePrinter:
+    def __init__(self):
+        self.reactor = FakeReactor()
+        self.objects = {'gcode': FakeGCode()}
+        self.event_handlers = {}
+
+    def get_reactor(self):
+        return self.reactor
+
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+
+    def lookup_object(self, name, default=FakeError):
+        if name in self.objects:
+            return self.objects[name]
+        if default is FakeError:
+            raise FakeError(f'Unknown object {name}')
+        return default
+
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+
+class FakeConfig:
+    # Options are given as the strings they would have in printer.cfg
+    error = FakeError
+
+    def __init__(self, printer, name, options=None):
+        self.printer = printer
+        self.name = name
+        self.options = dict(options or {})
+
+    def get_printer(self):
+        return self.printer
+
+    def get_name(self):
+        return self.name
+
+    def get(self, option, default=FakeError):
+        if option in self.options:
+            return self.options[option]
+        if default is FakeError:
+            raise FakeError(f'Option {option} is required')
+        return default
+
+    def getfloat(self, option, default=FakeError, **kwargs):
+        value = self.get(option, default)
+        return value if value is None else float(value)
+
+    def getint(self, option, default=FakeError, **kwargs):
+        value = self.get(option, default)
+        return value if value is None else int(value)
+
+    def getboolean(self, option, default=FakeError):
+        value = self.get(option, default)
+        if isinstance(value, str):
+            return value.lower() in ('1', 'true', 'yes')
+        return value
+
+    def getchoice(self, option, choices, default=FakeError):
+        return choices[self.get(option, default)]
+
+    def getlists(self, option, default=FakeError, seps=(',',), count=None,
+                 parser=str):
+        if option not in self.options:
+            return self.get(option, default)
+        def split(text, seps):
+            items = [item.strip() for item in text.split(seps[-1])]
+            items = [item for item in items if item]
+            if len(seps) == 1:
+                return tuple(parser(item) for item in items)
+            return tuple(split(item, seps[:-1]) for item in items)
+        return split(self.options[option], seps)
+
+    def getfloatlist(self, option, default=FakeError, sep=',', count=None):
+        if option not in self.options:
+            return self.get(option, default)
+        return tuple(float(item) for item in self.options[option].split(sep))
@@ -0,0 +1,34 @@
+import pytest
+from extras import brush
+from klippy_fakes import FakeConfig, FakePrinter
+
+@pytest.fixture
+def brusher():
+    return brush.load_config(FakeConfig(FakePrinter(), 'brush', {
+        'brush_movement': '20', 'brush_shift': '10', 'brush_length': '50',
+        'brush_offset': '110', 'brush_x_pos': '0', 'brush_y_pos': '100',
+        'brush_speed': '100', 'safe_z_pos_for_brush': '30',
+        'brush_pattern': 'diagonal', 'brush_passes': '4'}))
+
+def total(moves):
+    return (sum(dx for dx, dy in moves), sum(dy for dx, dy in moves))
+
+@pytest.mark.parametrize('pattern', ['diagonal', 'zigzag'])
+def test_pass_moves_shift_along_brush(brusher, pattern):
+    assert total(brusher.pass_moves(pattern)) == (20., 0.)
+
+def test_wipe_returns_to_start(brusher):
+    assert total(brusher.pass_moves('wipe')) == (0., 0.)
+
+@pytest.mark.parametrize('pattern, start_x', [
+    ('diagonal', -110.), ('zigzag', -50.), ('wipe', 0.)])
+def test_pattern_moves_start_on_brush(brusher, pattern, start_x):
+    moves = brusher.pattern_moves(pattern, 3)
+    assert moves[0] == (0., -20.)
+    assert total(moves) == (start_x + 3 * total(
+        brusher.pass_moves(pattern))[0], -20.)
+
+def test_pattern_moves_repeat_passes(brusher):
+    one = brusher.pattern_moves('zigzag', 1)
+    four = brusher.pattern_moves('zigzag', 4)
+    assert len(four) - len(one) == 3 * len(brusher.pass_moves('zigzag'))
@@ -0,0 +1,83 @@
+import math, types
+import pytest
+from extras import carriage_changer
+from klippy_fakes import FakeConfig, FakePrinter
+
+def test_move_time_at_rest():
+    assert carriage_changer.move_time(0., 100., 1000.) == 0.
+    assert carriage_changer.move_time(-1., 100., 1000.) == 0.
+
+def test_move_time_short_move_never_reaches_speed():
+    # 1mm at 1000mm/s^2 accelerates for half and decelerates for half
+    assert carriage_changer.move_time(1., 100., 1000.) == pytest.approx(
+        2. * math.sqrt(1. / 1000.))
+
+def test_move_time_long_move_cruises():
+    # 100mm at 100mm/s takes 1s plus the time lost to accelerating
+    assert carriage_changer.move_time(100., 100., 1000.) == pytest.approx(1.1)
+
+def test_move_time_is_continuous():
+    # 10mm is exactly enough to reach 100mm/s at 1000mm/s^2 and stop again
+    short = carriage_changer.move_time(10. - 1e-9, 100., 1000.)
+    long = carriage_changer.move_time(10., 100., 1000.)
+    assert short == pytest.approx(long)
+
+class Dock:
+    def exchange_moves(self, engage):
+        return [(0., 10., 50.), (0., -10., 50.)]
+
+def estimate(steps, position=None):
+    changer = types.SimpleNamespace(align_speed=6000., acceleration=1000.,
+                                    loading_pause=100.)
+    return carriage_changer.CarriageChanger.estimate_plan_time(
+        changer, steps, position)
+
+def test_estimate_plan_time_skips_travel_to_first_dock():
+    Step = carriage_changer.ToolChangeStep
+    steps = [Step('move', (100., 0.)), Step('move', (100., 100.))]
+    assert estimate(steps) == pytest.approx(
+        carriage_changer.move_time(100., 100., 1000.))
+    assert estimate(steps, (0., 0.)) == pytest.approx(
+        2. * carriage_changer.move_time(100., 100., 1000.))
+
+def test_estimate_plan_time_adds_dwells_and_exchanges():
+    Step = carriage_changer.ToolChangeStep
+    steps = [Step('dwell', (0.25,)), Step('exchange', (Dock(), True))]
+    # One loading pause between the two exchange moves
+    assert estimate(steps) == pytest.approx(
+        0.25 + 0.1 + 2. * carriage_changer.move_time(10., 50., 1000.))
+
+def test_estimate_plan_time_follows_exchange_moves():
+    Step = carriage_changer.ToolChangeStep
+    steps = [Step('move', (0., 0.)), Step('exchange', (Dock(), False)),
+             Step('move', (0., 100.))]
+    exchange = estimate(steps[1:2])
+    assert estimate(steps) == pytest.approx(
+        exchange + carriage_changer.move_time(100., 100., 1000.))
+
+COSTS = {('A', 'B'): 1., ('B', 'A'): 1., ('A', 'C'): 5., ('C', 'A'): 5.,
+         ('B', 'C'): 1., ('C', 'B'): 1., (None, 'A'): 2., (None, 'B'): 2.,
+         (None, 'C'): 2.}
+
+@pytest.fixture
+def optimizer():
+    changer = types.SimpleNamespace(
+        estimate_change_time=lambda from_name, to_name: COSTS[
+            (from_name, to_name)])
+    return carriage_changer.ToolOrderOptimizer(
+        FakeConfig(FakePrinter(), 'carriage_changer'), changer)
+
+def test_order_tools_finds_cheapest_order(optimizer):
+    assert optimizer.order_tools(('C', 'A', 'B'), 'A') == ('A', 'B', 'C')
+
+def test_order_tools_keeps_order_on_tie(optimizer):
+    assert optimizer.order_tools(('B', 'A'), None) == ('B', 'A')
+    assert optimizer.order_tools(('A', 'B'), None) == ('A', 'B')
+
+def test_order_tools_costs_nothing_to_stay(optimizer):
+    # Starting with the active tool needs no change at all
+    assert optimizer.order_tools(('C', 'B'), 'B') == ('B', 'C')
+
+def test_order_tools_greedy_past_exhaustive_limit(optimizer):
+    optimizer.MAX_EXHAUSTIVE_TOOLS = 2
+    assert optimizer.order_tools(('C', 'A', 'B'), 'A') == ['A', 'B', 'C']
@@ -0,0 +1,140 @@
+import types
+import pytest
+
+# extruder_management loads the probe helpers, which need the klippy modules
+pytest.importorskip('pins')
+from extras import extruder_management as em
+from klippy_fakes import FakeConfig, FakePrinter
+
+def test_fit_scale():
+    assert em.fit_scale([1., 2., 3.], [2., 4., 6.]) == pytest.approx(2.)
+    assert em.fit_scale([1., 1.], [0.9, 1.1]) == pytest.approx(1.)
+
+@pytest.mark.parametrize('xs', [[], [0., 0.]])
+def test_fit_scale_needs_samples(xs):
+    with pytest.raises(ValueError):
+        em.fit_scale(xs, [1.] * len(xs))
+
+def test_fit_line():
+    slope, intercept = em.fit_line([0., 0.04, 0.08], [-0.1, 0., 0.1])
+    assert slope == pytest.approx(2.5)
+    assert intercept == pytest.approx(-0.1)
+
+@pytest.mark.parametrize('xs', [[], [0.04], [0.04, 0.04]])
+def test_fit_line_needs_two_values(xs):
+    with pytest.raises(ValueError):
+        em.fit_line(xs, [0.] * len(xs))
+
+FILAMENTS = ('extruder1, 202020, PLA\n'
+             'extruder2, FFFFFF, PLA\n'
+             'extruder3, 202020, PETG\n'
+             'extruder4, 202020, PLA')
+
+def make_manager(options=None):
+    printer = FakePrinter()
+    heater = types.SimpleNamespace(get_temp=lambda eventtime: (200., 200.))
+    for name in ('extruder1', 'extruder2', 'extruder3', 'extruder4'):
+        printer.add_object(name, types.SimpleNamespace(
+            get_heater=lambda: heater, last_position=0.))
+    printer.add_object('carriage_changer',
+                       types.SimpleNamespace(loaded_carriage=None))
+    config_options = {'purge_length': '10', 'min_purge_length': '1',
+                      'material_change_purge_length': '5',
+                      'short_purge_length': '2', 'filaments': FILAMENTS}
+    config_options.update(options or {})
+    manager = em.load_config(
+        FakeConfig(printer, 'extruder_management', config_options))
+    manager.handle_connect()
+    return manager
+
+def change(manager, name):
+    changer = manager.carriage_changer
+    if changer.loaded_carriage is not None:
+        manager.handle_unloaded(changer.loaded_carriage)
+    changer.loaded_carriage = name
+    manager.handle_loaded(name)
+
+def test_calc_purge_length_without_history():
+    manager = make_manager()
+    assert manager.calc_purge_length(None, 'extruder1') == 10.
+    assert manager.calc_purge_length('extruder1', 'extruder1') == 1.
+
+def test_calc_purge_length_dark_to_light():
+    manager = make_manager()
+    lighten = manager.calc_purge_length('extruder1', 'extruder2')
+    darken = manager.calc_purge_length('extruder2', 'extruder1')
+    assert lighten == pytest.approx(10.)
+    assert 1. < darken < lighten
+
+def test_calc_purge_length_same_filament():
+    assert make_manager().calc_purge_length(
+        'extruder1', 'extruder4') == pytest.approx(1.)
+
+def test_calc_purge_length_material_change():
+    assert make_manager().calc_purge_length(
+        'extruder1', 'extruder3') == pytest.approx(6.)
+
+def test_calc_purge_length_unknown_filament():
+    assert make_manager({'filaments': 'extruder1, 202020'}).calc_purge_length(
+        'extruder1', 'extruder2') == 10.
+
+def test_calc_purge_length_listed():
+    manager = make_manager({'purge_lengths': 'extruder1, extruder2, 3'})
+    assert manager.calc_purge_length('extruder1', 'extruder2') == 3.
+
+@pytest.fixture
+def manager():
+    # Every extruder has been cleaned, and extruder1 is loaded
+    manager = make_manager()
+    for name in ('extruder2', 'extruder3', 'extruder4', 'extruder1'):
+        change(manager, name)
+        manager.record_cleaned(name, em.CLEAN_FULL)
+    return manager
+
+def test_choose_cleaning_first_load():
+    manager = make_manager()
+    change(manager, 'extruder1')
+    assert manager.choose_cleaning('extruder1') == em.CLEAN_FULL
+
+def test_choose_cleaning_reload_same_extruder(manager):
+    change(manager, 'extruder1')
+    assert manager.choose_cleaning('extruder1') == em.CLEAN_NONE
+
+def test_choose_cleaning_same_filament(manager):
+    assert manager.choose_cleaning('extruder4') == em.CLEAN_NONE
+    change(manager, 'extruder4')
+    assert manager.choose_cleaning('extruder4') == em.CLEAN_NONE
+
+def test_choose_cleaning_dark_to_light(manager):
+    # Before and after the load
+    assert manager.choose_cleaning('extruder2') == em.CLEAN_PURGE
+    change(manager, 'extruder2')
+    assert manager.choose_cleaning('extruder2') == em.CLEAN_PURGE
+
+def test_choose_cleaning_material_change(manager):
+    assert manager.choose_cleaning('extruder3') == em.CLEAN_PURGE
+
+def test_choose_cleaning_below_threshold():
+    manager = make_manager({'transition_purge_threshold': '6'})
+    for name in ('extruder3', 'extruder1'):
+        change(manager, name)
+        manager.record_cleaned(name, em.CLEAN_FULL)
+    assert manager.choose_cleaning('extruder3') == em.CLEAN_NONE
+
+def test_choose_cleaning_after_interval(manager):
+    manager.reactor.now += 600.
+    assert manager.choose_cleaning('extruder4') == em.CLEAN_BRUSH
+    assert manager.choose_cleaning('extruder2') == em.CLEAN_FULL
+
+def test_choose_cleaning_after_extruding(manager):
+    manager.lookup_extruder('extruder1').last_position += 1000.
+    assert manager.choose_cleaning('extruder1') == em.CLEAN_BRUSH
+
+def test_choose_cleaning_after_oozing(manager):
+    # extruder4 has been parked hot since the fixture loaded extruder1
+    manager.reactor.now += 30.
+    change(manager, 'extruder4')
+    assert manager.choose_cleaning('extruder4') == em.CLEAN_NONE
+    manager.reactor.now += 60.
+    change(manager, 'extruder1')
+    assert manager.choose_cleaning('extruder1') == em.CLEAN_PURGE